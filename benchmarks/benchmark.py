@@ -0,0 +1,225 @@
+import argparse
+import functools
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List
+
+# Measures the mail cycle of mail2cospend against a local fake IMAP server (in a separate process, so its memory
+# is not part of the measured peak RSS) and a stub cospend/ntfy endpoint. The mail2cospend settings are read from
+# the environment like in the service (e.g. IMAP_FETCH_MODE, IMAP_CONNECTIONS), only the servers are replaced.
+#
+#   uv run python benchmarks/benchmark.py --mails 10000 --cycles 2 --json result.json
+
+START = datetime(2024, 1, 1)
+
+
+def _serve_imap(count: int, attachment_kb: int, connection):
+    import fakeimap
+    import mails
+    server = fakeimap.FakeImapServer()
+    for raw in mails.generate(count, START, attachment_kb):
+        server.mailboxes['Inbox'].add(raw)
+    connection.send(server.start())
+    threading.Event().wait()
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    posts: Dict[str, int] = dict(bills=0, ntfy=0)
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, body: bytes):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._reply(json.dumps({"categories": {}, "paymentmodes": {}, "members": [
+            {"id": 1, "activated": True, "color": "000000", "name": "benchmark", "weight": 1}]}).encode())
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with self.lock:
+            self.posts['bills' if '/bills' in self.path else 'ntfy'] += 1
+        self._reply(b'1')
+
+
+# Sums up the time spent in each stage. Nested stages are subtracted from the enclosing one, so every second of a
+# (single threaded) cycle is counted once.
+class StageTimer:
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.durations: Dict[str, List[float]] = dict()
+
+    def reset(self):
+        self.durations = dict()
+
+    def wrap(self, owner, attribute: str, stage: str):
+        function = getattr(owner, attribute)
+
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            return self.measure(stage, function, *args, **kwargs)
+
+        setattr(owner, attribute, timed)
+
+    def measure(self, stage: str, function: Callable, *args, **kwargs):
+        stack = self._local.__dict__.setdefault('stack', [])
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            with self._lock:
+                self.durations.setdefault(stage, []).append(elapsed - nested)
+
+    def summary(self) -> Dict[str, dict]:
+        result = dict()
+        for stage, durations in self.durations.items():
+            durations = sorted(durations)
+            result[stage] = dict(calls=len(durations), total_s=sum(durations),
+                                 mean_ms=1000 * sum(durations) / len(durations),
+                                 p95_ms=1000 * durations[min(len(durations) - 1, int(len(durations) * 0.95))])
+        return result
+
+
+def _install_timers(timer: StageTimer):
+    import imaplib
+    import PyPDF2
+    from mail2cospend import cospendconnector, imapparser, mailconnector, ntfy
+    from mail2cospend.outbox import Outbox
+    from mail2cospend.parsecache import ParseCache
+    from mail2cospend.publishedids import PublishedIdStore
+    from mail2cospend.searchadapter import all_search_adapters, SearchAdapter
+    from mail2cospend.syncstate import SyncState
+
+    uid = imaplib.IMAP4.uid
+
+    @functools.wraps(uid)
+    def timed_uid(imap, command, *args):
+        return timer.measure('search' if command.upper() == 'SEARCH' else 'fetch', uid, imap, command, *args)
+
+    imaplib.IMAP4.uid = timed_uid
+    timer.wrap(mailconnector, 'parse_fetch_response', 'mime')
+    timer.wrap(imapparser.BodyPart, 'decode', 'mime')
+    timer.wrap(SearchAdapter, 'parse_message', 'mime')
+    timer.wrap(SearchAdapter, '_parse_pdf', 'pdf')
+    timer.wrap(PyPDF2.PageObject, 'extract_text', 'pdf')
+    for adapter_cls in all_search_adapters:
+        timer.wrap(adapter_cls, '_get_bon_from_pdf', 'extract')
+        timer.wrap(adapter_cls, '_get_bon_from_text', 'extract')
+    timer.wrap(cospendconnector, '_publish_bon', 'publish')
+    timer.wrap(ntfy.Ntfy, 'publish_bon_summary', 'notify')
+    for owner, attribute in [(ParseCache, 'get'), (ParseCache, 'put'), (ParseCache, 'commit'),
+                             (Outbox, 'enqueue'), (Outbox, 'take_due'), (Outbox, 'done'),
+                             (PublishedIdStore, 'add'), (PublishedIdStore, 'flush'), (SyncState, 'commit')]:
+        timer.wrap(owner, attribute, 'state')
+
+
+def _run_cycle(config, adapters, stores, pdf_executor) -> dict:
+    # The same steps as one cycle of mail2cospend.main.run_account
+    from mail2cospend.dispatcher import SearchDispatcher
+    from mail2cospend.mailconnector import get_imap_connection
+    from mail2cospend.main import close_imap_connection, finish_cycle, search_and_enqueue
+    sync_state, parse_cache, published_ids, outbox = stores
+
+    start = time.perf_counter()
+    imap = get_imap_connection(config)
+    dispatcher = SearchDispatcher(config, imap, adapters, published_ids, sync_state, parse_cache, pdf_executor)
+    found = search_and_enqueue(config, dispatcher, outbox, published_ids)
+    close_imap_connection(imap, adapters)
+    finish_cycle(config, sync_state, outbox, published_ids, start)
+    elapsed = time.perf_counter() - start
+    return dict(seconds=elapsed, mails=dispatcher.searched_mails, fetched_bytes=dispatcher.fetched_bytes, bons=found,
+                mails_per_second=dispatcher.searched_mails / elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark a mail2cospend cycle against local stand-in servers.")
+    parser.add_argument('--mails', type=int, default=1000, help="number of mails in the inbox (default: 1000)")
+    parser.add_argument('--cycles', type=int, default=2,
+                        help="number of cycles, the first one is cold, the others run incrementally (default: 2)")
+    parser.add_argument('--attachment-kb', type=int, default=0,
+                        help="size of an additional image attachment of every mail (default: 0)")
+    parser.add_argument('--json', help="write the results to this file")
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    imap_process = context.Process(target=_serve_imap, args=(args.mails, args.attachment_kb, sender), daemon=True)
+    print(f"Generating {args.mails} mails ...", file=sys.stderr)
+    imap_process.start()
+    imap_port = receiver.recv()
+
+    http = ThreadingHTTPServer(('127.0.0.1', 0), _StubHandler)
+    threading.Thread(target=http.serve_forever, daemon=True).start()
+    http_url = f"http://127.0.0.1:{http.server_address[1]}"
+
+    json_path = os.path.abspath(args.json) if args.json else None
+    workdir = tempfile.mkdtemp(prefix="mail2cospend-benchmark-")
+    os.chdir(workdir)
+    os.environ.update(IMAP_HOST='127.0.0.1', IMAP_PORT=str(imap_port), IMAP_SSL='false', IMAP_USER='benchmark',
+                      IMAP_PASSWORD='benchmark', IMAP_INBOX='Inbox', SINCE=START.date().isoformat(),
+                      COSPEND_PROJECT_URL=f"{http_url}/index.php/apps/cospend/api/projects/benchmark",
+                      COSPEND_PAYER_DEFAULT='1', COSPEND_PAYED_FOR_DEFAULT='1', NTFY_URL=f"{http_url}/ntfy",
+                      LOGLEVEL=os.environ.get('LOGLEVEL') or 'WARNING')
+
+    from mail2cospend.config import load_config
+    from mail2cospend.main import create_pdf_executor, exit_event, load_adapters
+    from mail2cospend.outbox import Outbox
+    from mail2cospend.parsecache import ParseCache
+    from mail2cospend.publishedids import PublishedIdStore
+    from mail2cospend.syncstate import SyncState
+
+    timer = StageTimer()
+    _install_timers(timer)
+    config = load_config(exit_event)
+    adapters = load_adapters(config)
+    stores = (SyncState(), ParseCache(), PublishedIdStore.from_config(config), Outbox.from_config(config))
+    pdf_executor = create_pdf_executor(config)
+
+    cycles = []
+    for number in range(1, args.cycles + 1):
+        timer.reset()
+        cycle = _run_cycle(config, adapters, stores, pdf_executor)
+        cycle['stages'] = timer.summary()
+        cycle['peak_rss_kib'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        cycles.append(cycle)
+        print(f"cycle {number}: {cycle['seconds']:.2f} s, {cycle['mails']} mails "
+              f"({cycle['mails_per_second']:.1f} mails/s), {cycle['fetched_bytes'] / 1024:.1f} KiB fetched, "
+              f"{cycle['bons']} bons, peak RSS {cycle['peak_rss_kib'] / 1024:.1f} MiB")
+        print(f"  {'stage':<10}{'calls':>8}{'total s':>10}{'mean ms':>10}{'p95 ms':>10}")
+        for stage, stats in sorted(cycle['stages'].items(), key=lambda item: -item[1]['total_s']):
+            print(f"  {stage:<10}{stats['calls']:>8}{stats['total_s']:>10.3f}{stats['mean_ms']:>10.3f}"
+                  f"{stats['p95_ms']:>10.3f}")
+    if pdf_executor is not None:
+        pdf_executor.shutdown()
+    imap_process.terminate()
+
+    if json_path:
+        settings = {key: value for key, value in config.__dict__.items()
+                    if key.startswith(('imap_fetch', 'imap_connections', 'parse_', 'publish_', 'pdf_'))}
+        with open(json_path, 'w') as f:
+            json.dump(dict(mails=args.mails, attachment_kb=args.attachment_kb, settings=settings,
+                           posted=_StubHandler.posts, cycles=cycles), f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
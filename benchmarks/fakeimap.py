@@ -0,0 +1,329 @@
+import email
+import email.header
+import email.utils
+import re
+import select
+import socketserver
+import threading
+from datetime import date, datetime
+from email import policy
+from email.message import Message
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from mail2cospend.imapparser import parse
+
+
+# A small in-memory IMAP4rev1 server for benchmarks: LOGIN, SELECT/EXAMINE, STATUS, UID SEARCH (FROM, SUBJECT,
+# HEADER, SINCE, BEFORE, UID, OR, NOT), UID FETCH (RFC822, INTERNALDATE, ENVELOPE, BODYSTRUCTURE,
+# BODY[section]) and IDLE.
+# Only the headers used by SEARCH are kept parsed, the mails are parsed again for each FETCH.
+
+class StoredMail:
+    __slots__ = ('uid', 'raw', 'from_', 'subject', 'received', 'date')
+
+    def __init__(self, uid: int, raw: bytes):
+        self.uid = uid
+        self.raw = raw
+        headers = email.message_from_bytes(raw.split(b'\r\n\r\n', 1)[0], policy=policy.compat32)
+        self.from_ = _decode_header(headers['from'])
+        self.subject = _decode_header(headers['subject'])
+        # Mails are "received" at the date of their Date header, SINCE and BEFORE compare the date of receipt
+        try:
+            self.received = email.utils.parsedate_to_datetime(headers['date'])
+        except (TypeError, ValueError):
+            self.received = datetime.now().astimezone()
+        if self.received.tzinfo is None:
+            self.received = self.received.astimezone()
+        self.date = self.received.replace(tzinfo=None).date()
+
+    def message(self) -> Message:
+        return email.message_from_bytes(self.raw, policy=policy.compat32)
+
+
+class Mailbox:
+
+    def __init__(self, uidvalidity: int = 1):
+        self.uidvalidity = uidvalidity
+        self.mails: List[StoredMail] = []
+        self.by_uid: Dict[int, Tuple[int, StoredMail]] = {}
+        self.next_uid = 1
+        self.condition = threading.Condition()
+
+    def add(self, raw: bytes):
+        with self.condition:
+            mail = StoredMail(self.next_uid, raw)
+            self.mails.append(mail)
+            self.by_uid[mail.uid] = (len(self.mails), mail)
+            self.next_uid += 1
+            self.condition.notify_all()
+
+    @property
+    def max_uid(self) -> int:
+        return self.mails[-1].uid if self.mails else 0
+
+
+def _decode_header(value: Optional[str]) -> str:
+    return str(email.header.make_header(email.header.decode_header(value or ''))).lower()
+
+
+def _quote(value) -> bytes:
+    if value is None:
+        return b'NIL'
+    if isinstance(value, str):
+        value = value.encode('utf-8', 'replace')
+    if b'\r' in value or b'\n' in value or b'"' in value or len(value) > 200:
+        return b'{%d}\r\n' % len(value) + value
+    return b'"' + value + b'"'
+
+
+def _payload(msg: Message) -> bytes:
+    payload = msg.get_payload()
+    return payload.encode('ascii', 'replace') if isinstance(payload, str) else b''
+
+
+def bodystructure(msg: Message) -> bytes:
+    if msg.is_multipart():
+        return (b'(' + b''.join(bodystructure(part) for part in msg.get_payload()) + b' ' +
+                _quote(msg.get_content_subtype().upper()) + b')')
+    maintype = msg.get_content_maintype().upper()
+    params = [item for key, value in (msg.get_params() or [])[1:] for item in (_quote(key.upper()), _quote(value))]
+    payload = _payload(msg)
+    fields = [_quote(maintype), _quote(msg.get_content_subtype().upper()),
+              b'(' + b' '.join(params) + b')' if params else b'NIL', b'NIL', b'NIL',
+              _quote((msg.get('Content-Transfer-Encoding') or '7BIT').upper()), b'%d' % len(payload)]
+    if maintype == 'TEXT':
+        fields.append(b'%d' % payload.count(b'\n'))
+    fields.append(b'NIL')
+    disposition = msg.get('Content-Disposition')
+    if disposition:
+        filename = msg.get_filename()
+        fields.append(b'(' + _quote(disposition.split(';')[0].strip()) + b' ' +
+                      (b'("FILENAME" ' + _quote(filename) + b')' if filename else b'NIL') + b')')
+    else:
+        fields.append(b'NIL')
+    fields.append(b'NIL')
+    return b'(' + b' '.join(fields) + b')'
+
+
+def _addresses(value: Optional[str]) -> bytes:
+    if not value:
+        return b'NIL'
+    out = []
+    for name, address in email.utils.getaddresses([value]):
+        mailbox, _, host = address.partition('@')
+        out.append(b'(' + _quote(name or None) + b' NIL ' + _quote(mailbox) + b' ' + _quote(host) + b')')
+    return b'(' + b''.join(out) + b')'
+
+
+def envelope(msg: Message) -> bytes:
+    sender = _addresses(msg['from'])
+    return b'(' + b' '.join([_quote(msg['date']), _quote(msg['subject']), sender, sender, sender,
+                             _addresses(msg['to']), b'NIL', b'NIL', b'NIL', _quote(msg['message-id'])]) + b')'
+
+
+def section_of(msg: Message, raw: bytes, section: str) -> bytes:
+    if section == '':
+        return raw
+    if section.upper().startswith('HEADER'):
+        return raw.split(b'\r\n\r\n', 1)[0] + b'\r\n\r\n'
+    part = msg
+    for number in section.split('.'):
+        if part.is_multipart():
+            part = part.get_payload()[int(number) - 1]
+    return _payload(part)
+
+
+def expand_set(spec: str, max_value: int) -> Iterator[int]:
+    for first, last in _ranges(spec, max_value):
+        yield from range(first, last + 1)
+
+
+def _parse_date(value: bytes) -> date:
+    return datetime.strptime(value.decode(), '%d-%b-%Y').date()
+
+
+def _evaluate(tokens: list, i: int, mail: StoredMail, max_uid: int) -> Tuple[bool, int]:
+    token = tokens[i]
+    if isinstance(token, list):
+        j, matches = 0, True
+        while j < len(token):
+            result, j = _evaluate(token, j, mail, max_uid)
+            matches = matches and result
+        return matches, i + 1
+    key = token.upper()
+    if key == b'OR':
+        first, i = _evaluate(tokens, i + 1, mail, max_uid)
+        second, i = _evaluate(tokens, i, mail, max_uid)
+        return first or second, i
+    if key == b'NOT':
+        result, i = _evaluate(tokens, i + 1, mail, max_uid)
+        return not result, i
+    if key == b'ALL':
+        return True, i + 1
+    if key == b'FROM':
+        return tokens[i + 1].decode().lower() in mail.from_, i + 2
+    if key == b'SUBJECT':
+        return tokens[i + 1].decode().lower() in mail.subject, i + 2
+    if key == b'HEADER':
+        name = tokens[i + 1].decode().lower()
+        value = mail.from_ if name == 'from' else mail.subject if name == 'subject' else ''
+        return tokens[i + 2].decode().lower() in value, i + 3
+    if key in (b'SINCE', b'SENTSINCE'):
+        return mail.date >= _parse_date(tokens[i + 1]), i + 2
+    if key in (b'BEFORE', b'SENTBEFORE'):
+        return mail.date < _parse_date(tokens[i + 1]), i + 2
+    if key == b'UID':
+        spec = tokens[i + 1].decode()
+        return any(first <= mail.uid <= last for first, last in _ranges(spec, max_uid)), i + 2
+    raise ValueError(f"Unsupported search key {key}")
+
+
+def _ranges(spec: str, max_value: int) -> Iterator[Tuple[int, int]]:
+    for item in spec.split(','):
+        first, _, last = item.partition(':')
+        first = max_value if first == '*' else int(first)
+        last = first if not last else (max_value if last == '*' else int(last))
+        yield min(first, last), max(first, last)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def _send(self, data: bytes):
+        self.wfile.write(data)
+        self.wfile.flush()
+
+    def _read_command(self) -> Optional[bytes]:
+        line = self.rfile.readline()
+        if not line:
+            return None
+        while (literal := re.search(rb'\{(\d+)\}\r\n$', line)) is not None:
+            self._send(b'+ go ahead\r\n')
+            line += self.rfile.read(int(literal.group(1))) + self.rfile.readline()
+        return line
+
+    def handle(self):
+        self._send(b'* OK benchmark IMAP server ready\r\n')
+        self.selected: Optional[Mailbox] = None
+        while True:
+            line = self._read_command()
+            if line is None:
+                return
+            tag, _, rest = line.rstrip(b'\r\n').partition(b' ')
+            command, _, args = rest.partition(b' ')
+            command = command.upper()
+            if command == b'UID':
+                sub_command, _, args = args.partition(b' ')
+                command = b'UID ' + sub_command.upper()
+            if not self._handle(tag, command, args):
+                return
+
+    def _handle(self, tag: bytes, command: bytes, args: bytes) -> bool:
+        mailboxes: Dict[str, Mailbox] = self.server.mailboxes
+        if command == b'CAPABILITY':
+            self._send(b'* CAPABILITY IMAP4rev1 IDLE\r\n' + tag + b' OK done\r\n')
+        elif command == b'LOGIN':
+            self._send(tag + b' OK [CAPABILITY IMAP4rev1 IDLE] logged in\r\n')
+        elif command == b'LOGOUT':
+            self._send(b'* BYE\r\n' + tag + b' OK bye\r\n')
+            return False
+        elif command in (b'SELECT', b'EXAMINE', b'STATUS'):
+            name = parse(args)[0].decode()
+            mailbox = mailboxes.get(name)
+            if mailbox is None:
+                self._send(tag + b' NO no such mailbox\r\n')
+            elif command == b'STATUS':
+                self._send(b'* STATUS %s (UIDVALIDITY %d UIDNEXT %d MESSAGES %d)\r\n%s OK done\r\n' % (
+                    name.encode(), mailbox.uidvalidity, mailbox.next_uid, len(mailbox.mails), tag))
+            else:
+                self.selected = mailbox
+                self._send(b'* %d EXISTS\r\n* OK [UIDVALIDITY %d]\r\n* OK [UIDNEXT %d]\r\n%s OK selected\r\n' % (
+                    len(mailbox.mails), mailbox.uidvalidity, mailbox.next_uid, tag))
+        elif command in (b'CLOSE', b'NOOP', b'CHECK'):
+            if command == b'CLOSE':
+                self.selected = None
+            self._send(tag + b' OK done\r\n')
+        elif command == b'IDLE':
+            return self._idle(tag)
+        elif command == b'UID SEARCH':
+            self._search(tag, args)
+        elif command == b'UID FETCH':
+            self._fetch(tag, args)
+        else:
+            self._send(tag + b' BAD unsupported command ' + command + b'\r\n')
+        return True
+
+    def _idle(self, tag: bytes) -> bool:
+        count = len(self.selected.mails)
+        self._send(b'+ idling\r\n')
+        while True:
+            with self.selected.condition:
+                if len(self.selected.mails) > count:
+                    count = len(self.selected.mails)
+                    self._send(b'* %d EXISTS\r\n' % count)
+            readable, _, _ = select.select([self.connection], [], [], 0.1)
+            if readable:
+                line = self.rfile.readline()
+                if not line:
+                    return False
+                if line.strip().upper() == b'DONE':
+                    self._send(tag + b' OK idle done\r\n')
+                    return True
+
+    def _search(self, tag: bytes, args: bytes):
+        tokens = parse(args)
+        if tokens and isinstance(tokens[0], bytes) and tokens[0].upper() == b'CHARSET':
+            tokens = tokens[2:]
+        max_uid = self.selected.max_uid
+        uids = []
+        for mail in self.selected.mails:
+            i, matches = 0, True
+            while i < len(tokens) and matches:
+                result, i = _evaluate(tokens, i, mail, max_uid)
+                matches = matches and result
+            if matches:
+                uids.append(mail.uid)
+        self._send(b'* SEARCH' + b''.join(b' %d' % uid for uid in uids) + b'\r\n' + tag + b' OK done\r\n')
+
+    def _fetch(self, tag: bytes, args: bytes):
+        spec, _, items = args.partition(b' ')
+        items = parse(items)
+        if items and isinstance(items[0], list):
+            items = items[0]
+        out = []
+        for uid in expand_set(spec.decode(), self.selected.max_uid):
+            if uid not in self.selected.by_uid:
+                continue
+            sequence, mail = self.selected.by_uid[uid]
+            msg = None
+            fields = [b'UID %d' % uid]
+            for item in items:
+                name = item.upper()
+                if name == b'RFC822':
+                    fields.append(b'RFC822 {%d}\r\n' % len(mail.raw) + mail.raw)
+                elif name == b'INTERNALDATE':
+                    fields.append(b'INTERNALDATE "%s"' % mail.received.strftime('%d-%b-%Y %H:%M:%S %z').encode())
+                elif name in (b'ENVELOPE', b'BODYSTRUCTURE') or name.startswith(b'BODY'):
+                    msg = msg or mail.message()
+                    if name == b'ENVELOPE':
+                        fields.append(b'ENVELOPE ' + envelope(msg))
+                    elif name == b'BODYSTRUCTURE':
+                        fields.append(b'BODYSTRUCTURE ' + bodystructure(msg))
+                    else:
+                        section = item[item.index(b'[') + 1:item.rindex(b']')].decode()
+                        data = section_of(msg, mail.raw, section)
+                        fields.append(b'BODY[%s] {%d}\r\n' % (section.encode(), len(data)) + data)
+            out.append(b'* %d FETCH (' % sequence + b' '.join(fields) + b')\r\n')
+        self._send(b''.join(out) + tag + b' OK done\r\n')
+
+
+class FakeImapServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int] = ('127.0.0.1', 0), inbox: str = 'Inbox'):
+        super().__init__(address, _Handler)
+        self.mailboxes: Dict[str, Mailbox] = {inbox: Mailbox()}
+
+    def start(self) -> int:
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self.server_address[1]
@@ -0,0 +1,111 @@
+from datetime import datetime, timedelta
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import format_datetime
+from typing import Iterator, List
+
+
+# Synthetic mails in the format the adapters expect, one generator per adapter plus a mail no adapter matches.
+
+def make_pdf(lines: List[str]) -> bytes:
+    # A minimal single page PDF with one text line per entry
+    content = b'BT /F1 10 Tf 14 TL 40 800 Td '
+    for line in lines:
+        content += b'(' + line.replace('(', '\\(').replace(')', '\\)').encode('latin-1') + b') Tj T* '
+    content += b'ET'
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+        b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents 4 0 R '
+        b'/Resources << /Font << /F1 5 0 R >> >> >>',
+        b'<< /Length %d >>\nstream\n' % len(content) + content + b'\nendstream',
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Courier >>',
+    ]
+    out = b'%PDF-1.4\n'
+    offsets = []
+    for i, obj in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b'%d 0 obj\n' % i + obj + b'\nendobj\n'
+    xref = len(out)
+    out += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    for offset in offsets:
+        out += b'%010d 00000 n \n' % offset
+    out += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+    return out
+
+
+def _mail(sender: str, subject: str, ts: datetime, n: int, parts: list, attachment_kb: int) -> bytes:
+    msg = MIMEMultipart('mixed')
+    msg['From'] = sender
+    msg['To'] = 'me@example.org'
+    msg['Subject'] = subject
+    msg['Date'] = format_datetime(ts)
+    msg['Message-ID'] = f'<{n}.{ts:%Y%m%d%H%M%S}@benchmark.example.org>'
+    for part in parts:
+        msg.attach(part)
+    if attachment_kb > 0:
+        msg.attach(MIMEApplication(b'\x89PNG' + bytes(attachment_kb * 1024), 'png', Name='logo.png'))
+    return msg.as_bytes().replace(b'\r\n', b'\n').replace(b'\n', b'\r\n')
+
+
+def _pdf_part(lines: List[str], filename: str) -> MIMEApplication:
+    part = MIMEApplication(make_pdf(lines), 'pdf')
+    part.add_header('Content-Disposition', 'attachment', filename=filename)
+    return part
+
+
+def _amount(total: float) -> str:
+    return f'{total:.2f}'.replace('.', ',')
+
+
+def rewe(ts: datetime, n: int, total: float, attachment_kb: int = 0) -> bytes:
+    lines = ['REWE Markt', 'Artikel 1 1,00', f'SUMME EUR {_amount(total)}',
+             f'{ts:%d.%m.%Y}     {ts:%H:%M}     Bon-Nr.:{n}']
+    return _mail('REWE <ebon@mailing.rewe.de>', 'Dein REWE eBon', ts, n,
+                 [MIMEText('<html>Dein Bon</html>' * 50, 'html'), _pdf_part(lines, f'REWE-eBon-{n}.pdf')],
+                 attachment_kb)
+
+
+def edeka(ts: datetime, n: int, total: float, attachment_kb: int = 0) -> bytes:
+    lines = ['EDEKA', f'SUMME EUR {_amount(total)}', f'Beleg-Nr. {n}', f'Datum {ts:%d.%m.%Y}',
+             f'Uhrzeit: {ts:%H:%M:%S} Uhr']
+    return _mail('EDEKA <noreply@app.edeka.de>', 'Vielen Dank für deinen Einkauf', ts, n,
+                 [MIMEText('Hallo', 'plain'), _pdf_part(lines, f'bon-{n}.pdf')], attachment_kb)
+
+
+def ikea(ts: datetime, n: int, total: float, attachment_kb: int = 0) -> bytes:
+    lines = ['IKEA', f'Gesamtsumme: {_amount(total)}', f'Rechnungsnummer: {n}', f'Rechnungsdatum: {ts:%d.%m.%Y}']
+    return _mail('IKEA <information@cm.order.email.ikea.com>', 'Deine Rechnung', ts, n,
+                 [MIMEText('Hallo', 'plain'), _pdf_part(lines, f'rechnung-{n}.pdf')], attachment_kb)
+
+
+def netto(ts: datetime, n: int, total: float, attachment_kb: int = 0) -> bytes:
+    text = f'Netto Marken-Discount\r\nArtikel\r\nSUMME {_amount(total)}\r\nDanke\r\n'
+    return _mail('Netto <nicht.antworten@reply.netto-online.de>', 'Ihr Einkauf bei Netto Marken-Discount!', ts, n,
+                 [MIMEText(text, 'plain'), MIMEText('<html>' + 'x' * 5000 + '</html>', 'html')], attachment_kb)
+
+
+def picnic(ts: datetime, n: int, total: float, attachment_kb: int = 0) -> bytes:
+    text = f'Hallo\r\nBestellung {n}\r\nGesamtbetrag {total:.2f}\r\n'
+    return _mail('Picnic <info@mail.picnic.de>', 'Dein Bon', ts, n, [MIMEText(text, 'plain', 'latin-1')],
+                 attachment_kb)
+
+
+def planted(ts: datetime, n: int, total: float, attachment_kb: int = 0) -> bytes:
+    text = f'Bestellung {n}\r\nTotal\r\n\r\n{_amount(total)} EUR\r\n'
+    return _mail('planted <shop@eatplanted.com>', f'Bestellung #{n} bestätigt', ts, n, [MIMEText(text, 'plain')],
+                 attachment_kb)
+
+
+def newsletter(ts: datetime, n: int, total: float, attachment_kb: int = 0) -> bytes:
+    return _mail('Shop <news@example.com>', 'Newsletter', ts, n, [MIMEText('Hello', 'plain')], attachment_kb)
+
+
+ALL = [rewe, edeka, ikea, netto, picnic, planted, newsletter]
+
+
+def generate(count: int, start: datetime, attachment_kb: int = 0) -> Iterator[bytes]:
+    # One mail every ten minutes, cycling through all kinds of mails
+    for i in range(count):
+        yield ALL[i % len(ALL)](start + timedelta(minutes=10 * i), 100000 + i, 1 + (i % 10000) / 100, attachment_kb)
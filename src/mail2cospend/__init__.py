@@ -1,3 +1,4 @@
+import datetime
 import logging
 import signal
 from pprint import pformat
@@ -6,6 +7,7 @@ import click
 
 from mail2cospend.config import load_config
 from mail2cospend.main import run as main_run, exit_event, print_cospend_project_infos
+from mail2cospend.profiling import profiler
 
 
 def quit(signo, _frame):
@@ -13,12 +15,18 @@ def quit(signo, _frame):
     exit_event.set()
 
 
+def profile_next_cycle(signo, _frame):
+    logging.info("Received %d, profiling the next cycle" % signo)
+    profiler.request(1)
+
+
 @click.group()
 @click.version_option()
 def cli():
     signal.signal(signal.SIGTERM, quit)
     signal.signal(signal.SIGINT, quit)
     signal.signal(signal.SIGHUP, quit)
+    signal.signal(signal.SIGUSR1, profile_next_cycle)
 
 
 @cli.command(
@@ -35,8 +43,48 @@ def project_infos():
     default=False,
     help='Do not actually do anything. Just print out possible new bons without publishing them.',
 )
-def run(dry=False):
-    main_run(dry=dry)
+@click.option(
+    '--engine',
+    '-e',
+    type=click.Choice(['sync', 'async']),
+    default='sync',
+    help='"sync" runs search and publishing one after another, "async" runs them as concurrent asyncio stages.',
+)
+@click.option(
+    '--profile',
+    'profile_cycles',
+    type=click.IntRange(min=0),
+    default=0,
+    help='Profile the first N cycles with cProfile and tracemalloc, the results are written to data/profiles/. '
+         'Send SIGUSR1 to profile the next cycle of a running process.',
+)
+def run(dry=False, engine='sync', profile_cycles=0):
+    if engine == 'async':
+        # The engines and the backfill are only imported by the command which uses them
+        from mail2cospend.asyncengine import run_async
+        run_async(dry=dry, profile_cycles=profile_cycles)
+    else:
+        main_run(dry=dry, profile_cycles=profile_cycles)
+
+
+@cli.command(help='Import the bons of a past date range. The range is split into shards which are searched in parallel '
+                   '(IMAP_CONNECTIONS), finished shards are skipped when the command is run again.')
+@click.option('--from', 'date_from', type=click.DateTime(formats=['%Y-%m-%d']), required=True,
+              help='The first day of the range (YYYY-MM-DD).')
+@click.option('--to', 'date_to', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+              help='The last day of the range (YYYY-MM-DD), default is today.')
+@click.option('--shard-days', type=click.IntRange(min=1), default=7, show_default=True,
+              help='The number of days searched per shard.')
+@click.option(
+    '--dry',
+    '-d',
+    is_flag=True,
+    default=False,
+    help='Do not actually do anything. Just print out possible new bons without publishing them.',
+)
+def backfill(date_from, date_to, shard_days=7, dry=False):
+    from mail2cospend.backfill import run_backfill
+    run_backfill(date_from.date(), date_to.date() if date_to is not None else datetime.date.today(), shard_days, dry)
 
 
 @cli.command(help='Print the current config.')
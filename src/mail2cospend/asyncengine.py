@@ -0,0 +1,151 @@
+import asyncio
+import imaplib
+import logging
+import time
+from typing import Optional
+
+from mail2cospend import metrics
+from mail2cospend.config import Config
+from mail2cospend.cospendconnector import publish_bongs
+from mail2cospend.data import BonSummary
+from mail2cospend.dispatcher import SearchDispatcher
+from mail2cospend.mailconnector import get_imap_connection, supports_idle, wait_for_new_mails
+from mail2cospend.main import init, load_adapters, validate_cospend_ids, close_imap_connection, exit_event, \
+    create_pdf_executor, finish_cycle, get_idle_timeout
+from mail2cospend.outbox import Outbox
+from mail2cospend.parsecache import ParseCache
+from mail2cospend.profiling import profiler
+from mail2cospend.publishedids import PublishedIdStore
+from mail2cospend.syncstate import SyncState
+
+
+# Runs the ingestion (fetch and parse) and the publishing as independent asyncio tasks, connected by a bounded
+# queue and the durable outbox. A slow cospend server therefore never delays the next mail cycle and new bons
+# are published while the remaining mails are still being parsed. The blocking IMAP and HTTP clients run in
+# worker threads, the exit event of the signal handlers stops all stages.
+class AsyncEngine:
+
+    def __init__(self, config: Config, dry: bool = False):
+        self.config = config
+        self.dry = dry
+        self.adapters = load_adapters(config)
+        validate_cospend_ids(config, self.adapters, dry)
+        self.sync_state = SyncState()
+        self.parse_cache = ParseCache()
+        self.published_ids = PublishedIdStore.from_config(config)
+        self.outbox = Outbox.from_config(config)
+        self.pdf_executor = create_pdf_executor(config)
+        self.imap: Optional[imaplib.IMAP4_SSL] = None
+        self.use_idle = config.imap_idle and not dry
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._bons: Optional[asyncio.Queue] = None
+        self._publish_wakeup: Optional[asyncio.Event] = None
+        # The UIDNEXT of the inbox when it was searched last
+        self._inbox_uidnext: Optional[int] = None
+        # Set when the ingestion ended, also if it failed without setting the exit event
+        self._stopping = False
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._bons = asyncio.Queue(maxsize=self.config.imap_fetch_batch_size)
+        self._publish_wakeup = asyncio.Event()
+        store = asyncio.create_task(self._store())
+        publisher = asyncio.create_task(self._publish()) if not self.dry else None
+        try:
+            await self._ingest()
+        finally:
+            if publisher is not None:
+                # Let the publisher finish the bons in flight, then the error of the ingestion (if any) is raised
+                self._stopping = True
+                self._publish_wakeup.set()
+                await publisher
+            store.cancel()
+            if self.imap is not None:
+                close_imap_connection(self.imap, self.adapters)
+            if self.pdf_executor is not None:
+                self.pdf_executor.shutdown()
+            self.published_ids.flush()
+
+    async def _ingest(self):
+        if self.dry:
+            logging.info("Dry run. Results:")
+        while not exit_event.is_set():
+            cycle_start = time.perf_counter()
+            try:
+                await asyncio.to_thread(self._search)
+            except (imaplib.IMAP4.abort, OSError):
+                logging.error("Lost the connection to the imap server, reconnecting.")
+                self.imap = None
+                continue
+            # Every bon of this cycle is in the outbox, before the mails are marked as processed
+            await self._bons.join()
+            if self.dry or exit_event.is_set():
+                break
+            # The bons are published by the publisher task
+            await asyncio.to_thread(finish_cycle, self.config, self.sync_state, self.outbox, self.published_ids,
+                                    cycle_start, publish=False)
+            await self._wait_for_next_cycle()
+
+    def _search(self):
+        # Runs in a worker thread, hands over each bon to the event loop (waits while the queue is full)
+        if self.imap is None:
+            self.imap = get_imap_connection(self.config)
+            if self.imap is None or exit_event.is_set():
+                exit(1)
+            if self.use_idle and not supports_idle(self.imap):
+                logging.warning(f"The imap server does not support IDLE, polling every {self.config.interval} seconds")
+                self.use_idle = False
+        dispatcher = SearchDispatcher(self.config, self.imap, self.adapters, self.published_ids, self.sync_state,
+                                      self.parse_cache, self.pdf_executor)
+        # Only the search and parsing is profiled, the publishing runs in other threads
+        with profiler.cycle():
+            for bon in dispatcher.search():
+                asyncio.run_coroutine_threadsafe(self._bons.put(bon), self._loop).result()
+        self._inbox_uidnext = dispatcher.uidnexts.get(self.config.imap_inbox)
+        if not self.use_idle:
+            close_imap_connection(self.imap, self.adapters)
+            self.imap = None
+
+    async def _wait_for_next_cycle(self):
+        if self.use_idle:
+            try:
+                await asyncio.to_thread(wait_for_new_mails, self.imap, self.config,
+                                        get_idle_timeout(self.config, self.adapters), self._inbox_uidnext)
+            except (imaplib.IMAP4.abort, OSError):
+                logging.error("Lost the connection to the imap server, reconnecting.")
+                self.imap = None
+        else:
+            logging.info(f"Waiting {self.config.interval} seconds before next run")
+            await asyncio.to_thread(exit_event.wait, self.config.interval)
+
+    async def _store(self):
+        while True:
+            bon: BonSummary = await self._bons.get()
+            if self.dry:
+                logging.info(bon)
+            else:
+                self.outbox.enqueue([bon])
+                self._publish_wakeup.set()
+            self._bons.task_done()
+
+    async def _publish(self):
+        # Publishes new bons as soon as they are stored and wakes up for due retries of the outbox
+        while not exit_event.is_set() and not self._stopping:
+            try:
+                await asyncio.wait_for(self._publish_wakeup.wait(), self.outbox.seconds_until_next_attempt())
+            except asyncio.TimeoutError:
+                pass
+            self._publish_wakeup.clear()
+            if exit_event.is_set() or self._stopping:
+                break
+            await asyncio.to_thread(publish_bongs, self.outbox, self.config, self.published_ids)
+
+
+def run_async(dry=False, profile_cycles: int = 0):
+    config = init()
+    metrics.enable(config.metrics_port)
+    profiler.request(profile_cycles or config.profile_cycles)
+    if config.imap_accounts_file is not None:
+        logging.warning(f"The async engine only searches the account of the IMAP_... environment variables, "
+                        f"the accounts of {config.imap_accounts_file} are only searched by the sync engine")
+    asyncio.run(AsyncEngine(config, dry).run())
@@ -0,0 +1,169 @@
+import dataclasses
+import imaplib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, timedelta
+from typing import List, Optional, Set
+
+from mail2cospend.config import Config
+from mail2cospend.cospendconnector import publish_bongs
+from mail2cospend.dispatcher import SearchDispatcher
+from mail2cospend.mailconnector import get_imap_connection
+from mail2cospend.main import init, load_adapters, validate_cospend_ids, close_imap_connection, exit_event
+from mail2cospend.outbox import Outbox
+from mail2cospend.publishedids import PublishedIdStore
+
+
+@dataclasses.dataclass(frozen=True)
+class Shard:
+    since: date
+    before: date
+
+    def key(self) -> str:
+        return f"{self.since.isoformat()}/{self.before.isoformat()}"
+
+
+@dataclasses.dataclass
+class ShardResult:
+    shard: Shard
+    mails: int
+    bytes: int
+    bons: int
+
+
+def get_shards(date_from: date, date_to: date, shard_days: int) -> List[Shard]:
+    # Splits [date_from, date_to] (both inclusive) into SINCE/BEFORE ranges of `shard_days` days
+    shards = []
+    since = date_from
+    end = date_to + timedelta(days=1)
+    while since < end:
+        before = min(end, since + timedelta(days=shard_days))
+        shards.append(Shard(since, before))
+        since = before
+    return shards
+
+
+# Remembers the finished shards, so an interrupted backfill continues with the missing ones.
+# A shard is finished once all of its bons are in the outbox.
+class BackfillCheckpoint:
+
+    def __init__(self, path: str = os.path.join("data", "backfill.json")):
+        self.path = path
+        self._lock = threading.Lock()
+        self._finished: Set[str] = self._load()
+
+    def _load(self) -> Set[str]:
+        try:
+            with open(self.path, 'r') as f:
+                return set(json.load(f))
+        except FileNotFoundError:
+            return set()
+        except (ValueError, OSError):
+            logging.warning(f"Backfill checkpoint {self.path} can not be read, starting from scratch")
+            return set()
+
+    def is_finished(self, shard: Shard) -> bool:
+        return shard.key() in self._finished
+
+    def finish(self, shard: Shard):
+        with self._lock:
+            self._finished.add(shard.key())
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.mkdir(directory)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(sorted(self._finished), f, indent=2)
+            os.replace(tmp_path, self.path)
+
+
+class Backfill:
+
+    def __init__(self, config: Config, dry: bool = False):
+        self.config = config
+        self.dry = dry
+        self.published_ids = PublishedIdStore.from_config(config)
+        self.outbox = Outbox.from_config(config)
+        self.checkpoint = BackfillCheckpoint()
+        validate_cospend_ids(config, load_adapters(config), dry)
+
+    def run(self, date_from: date, date_to: date, shard_days: int):
+        shards = [shard for shard in get_shards(date_from, date_to, shard_days)
+                  if self.dry or not self.checkpoint.is_finished(shard)]
+        logging.info(f"Backfilling {date_from} to {date_to} in {len(shards)} shards "
+                     f"with {self.config.imap_connections} connections")
+        start = time.monotonic()
+        mails, size, bons, done, failed = 0, 0, 0, 0, 0
+        # One connection per worker, the shards themselves are searched with a single connection each
+        with ThreadPoolExecutor(max_workers=self.config.imap_connections) as executor:
+            futures = {executor.submit(self._run_shard, shard): shard for shard in shards}
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except (imaplib.IMAP4.error, OSError) as e:
+                    # The shard is not marked as finished, so the next backfill searches it again
+                    failed += 1
+                    logging.error(f"Shard {futures[future].key()} failed: {e}")
+                    continue
+                if result is None:
+                    continue
+                done += 1
+                mails += result.mails
+                size += result.bytes
+                bons += result.bons
+                elapsed = max(time.monotonic() - start, 1e-9)
+                logging.info(f"Shard {result.shard.key()} done ({done}/{len(shards)}): {result.mails} mails, "
+                             f"{result.bons} bons | {mails / elapsed:.1f} mails/s, {size / elapsed / 1024:.1f} KiB/s, "
+                             f"{bons / elapsed:.1f} bons/s")
+                if not self.dry:
+                    publish_bongs(self.outbox, self.config, self.published_ids)
+        elapsed = max(time.monotonic() - start, 1e-9)
+        logging.info(f"Backfill finished {done}/{len(shards)} shards in {elapsed:.1f} seconds: {mails} mails, "
+                     f"{size} bytes, {bons} bons")
+        if failed > 0:
+            logging.warning(f"{failed} shards failed, run the backfill again to search them")
+        if self.dry:
+            return
+        # Also publishes the bons of an earlier, interrupted backfill
+        publish_bongs(self.outbox, self.config, self.published_ids)
+        self.published_ids.flush()
+        if self.outbox.seconds_until_next_attempt() is not None:
+            logging.info("Some bons could not be published yet, they are retried by the run command")
+
+    def _run_shard(self, shard: Shard) -> Optional[ShardResult]:
+        if exit_event.is_set():
+            return None
+        shard_config = dataclasses.replace(self.config, since=shard.since.isoformat(),
+                                           before=shard.before.isoformat(), imap_connections=1)
+        adapters = load_adapters(shard_config)
+        imap = get_imap_connection(shard_config)
+        if imap is None:
+            raise ConnectionError("No connection to the imap server")
+        try:
+            # No sync state and parse cache: a shard is always searched completely and only once
+            dispatcher = SearchDispatcher(shard_config, imap, adapters, self.published_ids)
+            found = list()
+            for bon in dispatcher.search():
+                if exit_event.is_set():
+                    return None
+                if self.dry:
+                    logging.info(bon)
+                found.append(bon)
+            if not self.dry:
+                self.outbox.enqueue(found)
+                self.checkpoint.finish(shard)
+            return ShardResult(shard, dispatcher.searched_mails, dispatcher.fetched_bytes, len(found))
+        finally:
+            close_imap_connection(imap, adapters)
+
+
+def run_backfill(date_from: date, date_to: date, shard_days: int = 7, dry: bool = False):
+    config = init()
+    if config.imap_accounts_file is not None:
+        logging.warning(f"The backfill only searches the account of the IMAP_... environment variables, "
+                        f"the accounts of {config.imap_accounts_file} are only searched by the sync engine")
+    Backfill(config, dry).run(date_from, date_to, shard_days)
@@ -2,14 +2,17 @@ import dataclasses
 import datetime
 import logging
 import os
+import re
 from dataclasses import field
 from threading import Event
-from typing import Optional, Dict
+from typing import Optional, Dict, List
 
+import yaml
 from dotenv import load_dotenv
 
+from mail2cospend.httpclient import PooledSession, get_http_session
 from mail2cospend.ntfy import Ntfy
-from mail2cospend.searchadapter import all_search_adapters, SearchAdapter
+from mail2cospend.searchadapter import get_adapter_names, SearchAdapter
 
 
 @dataclasses.dataclass(frozen=True)
@@ -30,7 +33,27 @@ class Config:
     imap_password: str
     imap_inbox: str
     imap_port: int
+    imap_ssl: bool
+    imap_fetch_mode: str
+    imap_fetch_batch_size: int
+    imap_idle: bool
+    imap_idle_timeout: int
+    imap_connections: int
+    imap_search_window_days: int
+    imap_accounts_file: Optional[str]
+    http_timeout: int
+    http_pool_size: int
+    publish_concurrency: int
+    publish_max_backoff: int
+    publish_max_attempts: int
+    metrics_port: Optional[int]
+    cospend_project_infos_ttl: int
+    profile_cycles: int
+    parse_processes: int
     interval: int
+    pdf_max_in_memory_size: int
+    published_ids_synchronous: str
+    published_ids_flush_size: int
     since: str
     exit_event: Event
     cospend_payed_for: Dict[str, str] = field(default_factory=dict)
@@ -38,6 +61,20 @@ class Config:
     cospend_categoryids: Dict[str, str] = field(default_factory=dict)
     cospend_paymentmodeids: Dict[str, str] = field(default_factory=dict)
     adapter_enabled: Dict[str, bool] = field(default_factory=dict)
+    imap_folders: Dict[str, str] = field(default_factory=dict)
+    # Upper bound (exclusive ISO date) of the searched mails, only used by the backfill
+    before: Optional[str] = None
+    # Name of the account of the accounts file, None for the account of the IMAP_... environment variables
+    account_name: Optional[str] = None
+
+    def __getstate__(self):
+        # The exit event can not be pickled (e.g. when parsing in a process pool)
+        state = dict(self.__dict__)
+        state['exit_event'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
 
     def get_cospend_payed_for(self, adapter: SearchAdapter | str) -> str:
         if isinstance(adapter, SearchAdapter):
@@ -64,19 +101,34 @@ class Config:
             adapter = adapter.adapter_name()
         return self.adapter_enabled.get(adapter)
 
-    def get_since_for_imap_query(self):
+    def get_imap_folder(self, adapter: SearchAdapter | str) -> Optional[str]:
+        if isinstance(adapter, SearchAdapter):
+            adapter = adapter.adapter_name()
+        return self.imap_folders.get(adapter)
+
+    def get_since_datetime(self) -> datetime.datetime:
         if self.since == "today":
-            since_dt = datetime.datetime.today()
-        else:
-            since_dt = datetime.datetime.fromisoformat(self.since)
-        return since_dt.strftime("%d-%b-%Y")
+            return datetime.datetime.combine(datetime.date.today(), datetime.time())
+        return datetime.datetime.fromisoformat(self.since)
+
+    def get_since_for_imap_query(self):
+        return self.get_since_datetime().strftime("%d-%b-%Y")
+
+    def get_before_for_imap_query(self) -> Optional[str]:
+        if self.before is None:
+            return None
+        return datetime.datetime.fromisoformat(self.before).strftime("%d-%b-%Y")
 
     @property
     def ntfy_is_enabled(self):
         return self.ntfy_url is not None and self.ntfy_url != ""
 
+    def get_http_session(self) -> PooledSession:
+        return get_http_session(self.http_timeout, self.http_pool_size)
+
     def get_ntfy_client(self) -> Ntfy:
-        return Ntfy(self.ntfy_url, self.ntfy_topic, self.ntfy_message_template, self.ntfy_bearer_auth_token)
+        return Ntfy(self.ntfy_url, self.ntfy_topic, self.ntfy_message_template, self.ntfy_bearer_auth_token,
+                    self.get_http_session())
 
 
 def load_config(exit_event: Event) -> Config:
@@ -87,7 +139,19 @@ def load_config(exit_event: Event) -> Config:
                         level=loglevel)
 
     imap_port = _try_load_int_from_env('IMAP_PORT', 993)
+    imap_ssl = _try_load_bool_from_env('IMAP_SSL', True)
     interval = _try_load_int_from_env('INTERVAL', 993)
+    pdf_max_in_memory_size = _try_load_int_from_env('PDF_MAX_IN_MEMORY_SIZE', 16 * 1024 * 1024)
+    published_ids_flush_size = _try_load_int_from_env('PUBLISHED_IDS_FLUSH_SIZE', 1)
+    published_ids_synchronous = (os.environ.get('PUBLISHED_IDS_SYNCHRONOUS') or 'NORMAL').upper()
+    if published_ids_synchronous not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+        logging.error(
+            f"Published ids synchronous mode must be OFF, NORMAL, FULL or EXTRA: was '{published_ids_synchronous}'")
+        exit(1)
+    imap_fetch_batch_size = _try_load_int_from_env('IMAP_FETCH_BATCH_SIZE', 50)
+    if imap_fetch_batch_size < 1:
+        logging.error(f"Environment parameter 'IMAP_FETCH_BATCH_SIZE' must be positive. Was '{imap_fetch_batch_size}'")
+        exit(1)
 
     cospend_payed_for_default = os.environ.get('COSPEND_PAYED_FOR_DEFAULT')
     cospend_payed_for_adapter = _try_load_adapter_config('PAYED_FOR', cospend_payed_for_default)
@@ -96,16 +160,37 @@ def load_config(exit_event: Event) -> Config:
     cospend_categoryid_default = os.environ.get('COSPEND_CATEGORYID_DEFAULT')
     cospend_categoryid_adapter = _try_load_adapter_config('CATEGORYID', cospend_categoryid_default)
     cospend_paymentmodeid_default = os.environ.get('COSPEND_PAYMENTMODEID_DEFAULT')
-    cospend_paymentmodeid_adapter = _try_load_adapter_config('PAYMENTMODEID', cospend_categoryid_default)
+    cospend_paymentmodeid_adapter = _try_load_adapter_config('PAYMENTMODEID', cospend_paymentmodeid_default)
     adapter_enabled = dict()
-    for adapter in all_search_adapters:
-        full_key = f"ADAPTER_{adapter.adapter_name().upper()}_ENABLED"
-        value = os.environ.get(full_key)
-        if value:
-            value = value.lower() not in "false,0,disabled,off".split(",")
-        else:
-            value = True
-        adapter_enabled[adapter.adapter_name()] = value
+    for adapter_name in get_adapter_names():
+        full_key = f"ADAPTER_{adapter_name.upper()}_ENABLED"
+        adapter_enabled[adapter_name] = _try_load_bool_from_env(full_key, True)
+    imap_folders = dict()
+    for adapter_name in get_adapter_names():
+        folder = os.environ.get(f"IMAP_FOLDER_{adapter_name.upper()}")
+        if folder:
+            imap_folders[adapter_name] = folder
+
+    imap_idle = _try_load_bool_from_env('IMAP_IDLE', False)
+    # Servers may drop IDLE connections after 29 minutes of inactivity (RFC 2177)
+    imap_idle_timeout = _try_load_int_from_env('IMAP_IDLE_TIMEOUT', 25 * 60)
+
+    imap_connections = max(1, _try_load_int_from_env('IMAP_CONNECTIONS', 1))
+    imap_search_window_days = max(0, _try_load_int_from_env('IMAP_SEARCH_WINDOW_DAYS', 7))
+    http_timeout = _try_load_int_from_env('HTTP_TIMEOUT', 30)
+    http_pool_size = max(1, _try_load_int_from_env('HTTP_POOL_SIZE', 10))
+    publish_concurrency = max(1, _try_load_int_from_env('PUBLISH_CONCURRENCY', 1))
+    publish_max_backoff = _try_load_int_from_env('PUBLISH_MAX_BACKOFF', 3600)
+    publish_max_attempts = max(1, _try_load_int_from_env('PUBLISH_MAX_ATTEMPTS', 20))
+    metrics_port = _try_load_int_from_env('METRICS_PORT')
+    cospend_project_infos_ttl = max(1, _try_load_int_from_env('COSPEND_PROJECT_INFOS_TTL', 3600))
+    profile_cycles = max(0, _try_load_int_from_env('PROFILE_CYCLES', 0))
+    parse_processes = max(0, _try_load_int_from_env('PARSE_PROCESSES', 0))
+
+    imap_fetch_mode = (os.environ.get('IMAP_FETCH_MODE') or 'partial').lower()
+    if imap_fetch_mode not in ('partial', 'full'):
+        logging.error(f"IMAP fetch mode must be 'partial' or 'full': was '{imap_fetch_mode}'")
+        exit(1)
 
     since = os.environ.get('SINCE') or 'today'
     if since != "today":
@@ -128,7 +213,27 @@ def load_config(exit_event: Event) -> Config:
         imap_password=os.environ.get('IMAP_PASSWORD'),
         imap_inbox=os.environ.get('IMAP_INBOX') or 'Inbox',
         imap_port=imap_port,
+        imap_ssl=imap_ssl,
+        imap_fetch_mode=imap_fetch_mode,
+        imap_fetch_batch_size=imap_fetch_batch_size,
+        imap_idle=imap_idle,
+        imap_idle_timeout=imap_idle_timeout,
+        imap_connections=imap_connections,
+        imap_search_window_days=imap_search_window_days,
+        imap_accounts_file=os.environ.get('IMAP_ACCOUNTS_FILE') or None,
+        http_timeout=http_timeout,
+        http_pool_size=http_pool_size,
+        publish_concurrency=publish_concurrency,
+        publish_max_backoff=publish_max_backoff,
+        publish_max_attempts=publish_max_attempts,
+        metrics_port=metrics_port,
+        cospend_project_infos_ttl=cospend_project_infos_ttl,
+        profile_cycles=profile_cycles,
+        parse_processes=parse_processes,
         interval=interval,
+        pdf_max_in_memory_size=pdf_max_in_memory_size,
+        published_ids_synchronous=published_ids_synchronous,
+        published_ids_flush_size=published_ids_flush_size,
         since=since,
         exit_event=exit_event,
         cospend_payed_for=cospend_payed_for_adapter,
@@ -140,6 +245,7 @@ def load_config(exit_event: Event) -> Config:
         ntfy_topic=os.environ.get('NTFY_TOPIC') or "mail2cospend",
         ntfy_message_template=os.environ.get('NTFY_MESSAGE_TEMPLATE') or "{sum}€ {adapter}/{document} ({timestamp})",
         adapter_enabled=adapter_enabled,
+        imap_folders=imap_folders,
     )
 
     return config
@@ -158,10 +264,118 @@ def _try_load_int_from_env(field: str, default: Optional[int] = None) -> Optiona
     return val
 
 
+def _try_load_bool_from_env(field: str, default: bool) -> bool:
+    value = os.environ.get(field)
+    if value:
+        return value.lower() not in "false,0,disabled,off".split(",")
+    return default
+
+
 def _try_load_adapter_config(key: str, default: str) -> Dict[str, str]:
     result = dict()
-    for adapter in all_search_adapters:
-        full_key = f"COSPEND_{key}_{adapter.adapter_name().upper()}"
+    for adapter_name in get_adapter_names():
+        full_key = f"COSPEND_{key}_{adapter_name.upper()}"
         value = os.environ.get(full_key) or default
-        result[adapter.adapter_name()] = value
+        result[adapter_name] = value
     return result
+
+
+# The settings of an account in the accounts file and the config fields they replace
+_ACCOUNT_SETTINGS = {
+    'host': 'imap_host',
+    'user': 'imap_user',
+    'password': 'imap_password',
+    'inbox': 'imap_inbox',
+    'port': 'imap_port',
+    'ssl': 'imap_ssl',
+    'idle': 'imap_idle',
+    'interval': 'interval',
+}
+
+
+def load_accounts(config: Config) -> List[Config]:
+    # One config per account of the accounts file (IMAP_ACCOUNTS_FILE), settings an account does not set are taken
+    # from the environment. Without an accounts file the IMAP_... environment variables are the only account.
+    if config.imap_accounts_file is None:
+        return [config]
+    try:
+        with open(config.imap_accounts_file, 'r') as f:
+            content = yaml.safe_load(f)
+    except (OSError, yaml.YAMLError) as e:
+        logging.error(f"Accounts file '{config.imap_accounts_file}' can not be read: {e}")
+        exit(1)
+    entries = content.get('accounts') if isinstance(content, dict) else None
+    if not isinstance(entries, list) or len(entries) == 0:
+        logging.error(f"Accounts file '{config.imap_accounts_file}' must contain a non-empty list of 'accounts'")
+        exit(1)
+    accounts = [_load_account(config, entry) for entry in entries]
+    names = [account.account_name for account in accounts]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if len(duplicates) > 0:
+        logging.error(f"Account names must be unique, found several accounts named {', '.join(duplicates)}")
+        exit(1)
+    return accounts
+
+
+def _load_account(config: Config, entry: object) -> Config:
+    name = entry.get('name') if isinstance(entry, dict) else None
+    # The name is part of the file name of the sync state of the account
+    if not isinstance(name, str) or re.fullmatch(r'[A-Za-z0-9_.-]+', name) is None:
+        logging.error(f"Each account needs a name of letters, digits, '_', '.' or '-': was '{name}'")
+        exit(1)
+    unknown = set(entry) - set(_ACCOUNT_SETTINGS) - {'name', 'folders', 'adapters'}
+    if len(unknown) > 0:
+        logging.error(f"Account '{name}' has unknown settings: {', '.join(sorted(map(str, unknown)))}")
+        exit(1)
+    adapter_names = {adapter_name.upper(): adapter_name for adapter_name in get_adapter_names()}
+
+    changes = dict(account_name=name)
+    for key, config_field in _ACCOUNT_SETTINGS.items():
+        value = entry.get(key)
+        if value is None:
+            continue
+        default = getattr(config, config_field)
+        if isinstance(default, bool):
+            value = value if isinstance(value, bool) else str(value).lower() not in "false,0,disabled,off".split(",")
+        elif isinstance(default, int):
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                logging.error(f"Setting '{key}' of account '{name}' is not an integer. Was '{value}'")
+                exit(1)
+        else:
+            value = str(value)
+        changes[config_field] = value
+
+    # Folders are added to the IMAP_FOLDER_{adapter} environment variables, which apply to all accounts
+    folders = entry.get('folders') or dict()
+    if not isinstance(folders, dict):
+        logging.error(f"The folders of account '{name}' must map adapter names to folders")
+        exit(1)
+    imap_folders = dict(config.imap_folders)
+    for adapter_name, folder in folders.items():
+        if str(adapter_name).upper() not in adapter_names:
+            logging.error(f"Account '{name}' has a folder for the unknown adapter '{adapter_name}'")
+            exit(1)
+        imap_folders[adapter_names[str(adapter_name).upper()]] = str(folder)
+    changes['imap_folders'] = imap_folders
+
+    # An account can be limited to some of the adapters which are enabled by ADAPTER_{adapter}_ENABLED
+    if entry.get('adapters') is not None:
+        if not isinstance(entry['adapters'], list):
+            logging.error(f"The adapters of account '{name}' must be a list of adapter names")
+            exit(1)
+        account_adapters = set()
+        for adapter_name in entry['adapters']:
+            if str(adapter_name).upper() not in adapter_names:
+                logging.error(f"Account '{name}' uses the unknown adapter '{adapter_name}'")
+                exit(1)
+            account_adapters.add(adapter_names[str(adapter_name).upper()])
+        changes['adapter_enabled'] = {adapter_name: enabled and adapter_name in account_adapters
+                                      for adapter_name, enabled in config.adapter_enabled.items()}
+
+    account = dataclasses.replace(config, **changes)
+    if not account.imap_host or not account.imap_user:
+        logging.error(f"Account '{name}' needs a host and a user (or IMAP_HOST and IMAP_USER)")
+        exit(1)
+    return account
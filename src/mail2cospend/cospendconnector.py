@@ -2,14 +2,19 @@ import dataclasses
 import datetime
 import enum
 import logging
+import threading
+import time
 from dataclasses import field
-from typing import List, Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional
 
 import requests
 
+from mail2cospend import metrics
 from mail2cospend.config import Config
 from mail2cospend.data import BonSummary
-from mail2cospend.helper import add_published_id
+from mail2cospend.outbox import Outbox
+from mail2cospend.publishedids import PublishedIdStore
 
 
 @dataclasses.dataclass(frozen=True)
@@ -49,7 +54,7 @@ class CospendProjectInfos:
 def test_connection(config: Config):
     url = _get_project_url(config, ApiType.INFOS)
     try:
-        result = requests.get(url)
+        result = config.get_http_session().get(url)
         if result.status_code < 400:
             logging.debug("Tested connection to the cospend project. Successful.")
             return True
@@ -68,17 +73,21 @@ def test_connection(config: Config):
 
 
 def get_cospend_project_infos(config: Config) -> CospendProjectInfos:
-    url = _get_project_url(config, ApiType.INFOS)
-    result = requests.get(url)
-    data = result.json()
+    return get_project_infos_cache(config).get()
+
+
+def _parse_project_infos(data) -> CospendProjectInfos:
+    if isinstance(data, list):
+        # Projects without a password only expose their members
+        data = dict(members=data)
 
     categories = dict()
-    for key, val in data["categories"].items():
+    for key, val in data.get("categories", dict()).items():
         categories[key] = Category(id=val["id"], color=val["color"], icon=val["icon"], name=val["name"],
                                    order=val["order"])
 
     paymentmodes = dict()
-    for key, val in data["paymentmodes"].items():
+    for key, val in data.get("paymentmodes", dict()).items():
         paymentmodes[key] = PaymentMode(id=val["id"], color=val["color"], icon=val["icon"], name=val["name"],
                                         order=val["order"])
 
@@ -90,23 +99,109 @@ def get_cospend_project_infos(config: Config) -> CospendProjectInfos:
     return CospendProjectInfos(categories, paymentmodes, members)
 
 
-def publish_bongs(bons: List[BonSummary], config: Config):
-    tries = 10
-    for i in range(tries):
-        if config.exit_event.is_set():
-            break
-        try:
-            _try_publish_bons(bons, config)
-            break
-        except:
-            logging.error("No connection to the cospend server.")
-            seconds_to_wait = config.interval * 2 ** i
-            logging.error(
-                f"Waiting {seconds_to_wait} seconds for the next try. ({i}/{tries})"
-            )
-            config.exit_event.wait(seconds_to_wait)
-            if i == tries - 1:
-                exit(1)
+# Keeps the project infos for `ttl` seconds. Refreshes use a conditional GET if the server sent an ETag,
+# and can run in a background thread, so publishing never waits for them.
+class ProjectInfosCache:
+
+    def __init__(self, config: Config, ttl: float):
+        self.config = config
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._infos: Optional[CospendProjectInfos] = None
+        self._etag: Optional[str] = None
+        self._loaded_at = 0.0
+        self._refresher: Optional[threading.Thread] = None
+
+    def get(self) -> CospendProjectInfos:
+        with self._lock:
+            # With the background refresh running, the cached infos are used until it replaces them
+            stale = self._refresher is None and time.monotonic() - self._loaded_at > self.ttl
+            if self._infos is None or stale:
+                self._refresh()
+            return self._infos
+
+    def refresh(self):
+        with self._lock:
+            self._refresh()
+
+    def _refresh(self):
+        headers = {'If-None-Match': self._etag} if self._etag else {}
+        result = self.config.get_http_session().get(_get_project_url(self.config, ApiType.INFOS), headers=headers)
+        if result.status_code == 304 and self._infos is not None:
+            logging.debug("Cospend project infos are unchanged")
+        else:
+            result.raise_for_status()
+            self._infos = _parse_project_infos(result.json())
+            self._etag = result.headers.get('ETag')
+            logging.debug("Loaded the cospend project infos")
+        self._loaded_at = time.monotonic()
+
+    def start_background_refresh(self):
+        if self._refresher is not None:
+            return
+        self._refresher = threading.Thread(target=self._refresh_periodically, daemon=True)
+        self._refresher.start()
+
+    def _refresh_periodically(self):
+        while not self.config.exit_event.wait(self.ttl):
+            try:
+                self.refresh()
+            except Exception as e:
+                logging.warning(f"Could not refresh the cospend project infos: {e}")
+
+    def validate(self, adapter_names: Iterable[str]) -> List[str]:
+        # Returns an error for every configured id the project does not know. Categories and payment modes
+        # are only checked if the project lists them, ids <= 0 are the predefined ones of cospend.
+        infos = self.get()
+        members = {str(member_id) for member_id in infos.members}
+        errors = []
+        for adapter_name in adapter_names:
+            payer = self.config.get_cospend_payer(adapter_name)
+            if payer and payer.strip() not in members:
+                errors.append(f"{adapter_name}: payer '{payer}' is not a member of the project")
+            for payed_for in (self.config.get_cospend_payed_for(adapter_name) or "").split(","):
+                if payed_for.strip() and payed_for.strip() not in members:
+                    errors.append(f"{adapter_name}: payed for '{payed_for.strip()}' is not a member of the project")
+            for kind, value, known in [("category", self.config.get_cospend_categoryid(adapter_name),
+                                        infos.categories),
+                                       ("payment mode", self.config.get_cospend_paymentmodeid(adapter_name),
+                                        infos.paymentmodes)]:
+                if not value or len(known) == 0 or str(value).strip() in {str(key) for key in known}:
+                    continue
+                if str(value).strip().lstrip('-').isdigit() and int(value) <= 0:
+                    continue
+                errors.append(f"{adapter_name}: {kind} '{value}' does not exist in the project")
+        return errors
+
+
+_project_infos_cache: Optional[ProjectInfosCache] = None
+
+
+def get_project_infos_cache(config: Config) -> ProjectInfosCache:
+    global _project_infos_cache
+    if _project_infos_cache is None:
+        _project_infos_cache = ProjectInfosCache(config, config.cospend_project_infos_ttl)
+    return _project_infos_cache
+
+
+def publish_bongs(outbox: Outbox, config: Config, published_ids: PublishedIdStore):
+    # Publishes the bons of the outbox whose next attempt is due, failed bons are rescheduled individually
+    bons = outbox.take_due()
+    if len(bons) > 0:
+        logging.info(f"Publishing {len(bons)} bons")
+    if config.publish_concurrency <= 1 or len(bons) <= 1:
+        for bon in bons:
+            _publish_outbox_bon(bon, outbox, config, published_ids)
+    else:
+        # Bulk mode: publish up to `publish_concurrency` bills at once over the pooled session
+        with ThreadPoolExecutor(max_workers=config.publish_concurrency) as executor:
+            for future in [executor.submit(_publish_outbox_bon, bon, outbox, config, published_ids) for bon in bons]:
+                future.result()
+
+
+# Responses which indicate a temporary problem of the cospend server, or of its configuration (a changed password or
+# project) which is fixed without the bill. Other client errors reject the bill itself.
+_RETRY_STATUS_CODES = {401, 403, 404, 408, 425, 429}
 
 
 class ApiType(enum.Enum):
@@ -136,31 +231,56 @@ def _get_project_url(config: Config, api_type: ApiType) -> str:
     return url
 
 
-def _try_publish_bons(bons: List[BonSummary], config: Config):
-    if len(bons) > 0:
-        logging.info(f"Found {len(bons)} bons")
-    for bon in bons:
-        logging.info(f"Pushing new bill: {bon}")
-        url = _get_project_url(config, ApiType.BILLS)
-
-        data = {
-            'amount': bon.sum,
-            'what': bon.adapter_name,
-            'payed_for': config.get_cospend_payed_for(bon.adapter_name),
-            'payer': config.get_cospend_payer(bon.adapter_name),
-            'timestamp': (bon.timestamp - datetime.datetime(1970, 1, 1)).total_seconds(),
-            'categoryid': config.get_cospend_categoryid(bon.adapter_name),
-            'paymentmodeid': config.get_cospend_paymentmodeid(bon.adapter_name),
-            'comment': bon.adapter_name + ' - Autopush ' + (('- Beleg: ' + bon.document) if bon.document else '')
-        }
-        logging.debug(f"Publishing data: {str(data)} to url {url}")
-        result = requests.post(url, json=data)
-        if result.status_code < 400:
-            add_published_id(bon)
-            logging.debug(f"Published bon {bon} and added to published file")
-            if config.ntfy_is_enabled:
-                config.get_ntfy_client().publish_bon_summary(bon)
+def _publish_outbox_bon(bon: BonSummary, outbox: Outbox, config: Config, published_ids: PublishedIdStore):
+    if bon.get_id() in published_ids:
+        # Published right before the last run stopped
+        outbox.done(bon)
+        return
+    if config.exit_event.is_set():
+        outbox.requeue(bon)
+        return
+    try:
+        errors = get_project_infos_cache(config).validate([bon.adapter_name])
+    except (requests.RequestException, ValueError):
+        # Unknown, let cospend decide
+        errors = []
+    if len(errors) > 0:
+        outbox.fail(bon, "; ".join(errors))
+        return
+    try:
+        with metrics.PUBLISH_SECONDS.time():
+            result = _publish_bon(bon, config)
+    except requests.RequestException as e:
+        metrics.PUBLISH_RESPONSES.labels(status='error').inc()
+        logging.error("No connection to the cospend server.")
+        outbox.retry(bon, str(e))
+        return
+    metrics.PUBLISH_RESPONSES.labels(status=result.status_code).inc()
+    if result.status_code < 400:
+        published_ids.add(bon)
+        outbox.done(bon)
+        logging.debug(f"Published bon {bon} and added to the published ids")
+        if config.ntfy_is_enabled:
+            config.get_ntfy_client().publish_bon_summary(bon)
+    elif result.status_code in _RETRY_STATUS_CODES or result.status_code >= 500:
+        outbox.retry(bon, f"{result.status_code}: {result.reason}")
+    else:
+        outbox.fail(bon, f"{result.status_code}: {result.reason}")
 
-        else:
-            logging.warning(f"Bon {bon} was not published to cospend!")
-            logging.warning(f"{result.status_code}: {result.reason}")
+
+def _publish_bon(bon: BonSummary, config: Config) -> requests.Response:
+    logging.info(f"Pushing new bill: {bon}")
+    url = _get_project_url(config, ApiType.BILLS)
+
+    data = {
+        'amount': bon.sum,
+        'what': bon.adapter_name,
+        'payed_for': config.get_cospend_payed_for(bon.adapter_name),
+        'payer': config.get_cospend_payer(bon.adapter_name),
+        'timestamp': (bon.timestamp - datetime.datetime(1970, 1, 1)).total_seconds(),
+        'categoryid': config.get_cospend_categoryid(bon.adapter_name),
+        'paymentmodeid': config.get_cospend_paymentmodeid(bon.adapter_name),
+        'comment': bon.adapter_name + ' - Autopush ' + (('- Beleg: ' + bon.document) if bon.document else '')
+    }
+    logging.debug(f"Publishing data: {str(data)} to url {url}")
+    return config.get_http_session().post(url, json=data)
@@ -18,3 +18,12 @@ class BonSummary:
             .replace("{timestamp}", self.timestamp.strftime("%Y-%m-%d %H:%M:%S")) \
             .replace("{document}", self.document) \
             .replace("{sum}", f"{self.sum:.2f}")
+
+    def as_dict(self) -> dict:
+        return dict(timestamp=self.timestamp.isoformat(), sum=self.sum, document=self.document,
+                    adapter_name=self.adapter_name)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'BonSummary':
+        return cls(timestamp=datetime.fromisoformat(data['timestamp']), sum=data['sum'], document=data['document'],
+                   adapter_name=data['adapter_name'])
@@ -0,0 +1,326 @@
+import functools
+import imaplib
+import logging
+import threading
+from email import utils
+from email.message import Message
+from email.parser import BytesParser
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from mail2cospend import metrics
+from mail2cospend.config import Config
+from mail2cospend.data import BonSummary
+from mail2cospend.imapparser import BodyPart, decode_mime_header, parse_bodystructure, parse_envelope, \
+    parse_internaldate
+from mail2cospend.mailconnector import ImapConnectionPool, get_uidnext, uid_fetch
+from mail2cospend.parsecache import ParseCache, get_cache_key
+from mail2cospend.publishedids import PublishedIdStore
+from mail2cospend.searchadapter import SearchAdapter
+from mail2cospend.searchadapter.searchadapter import MailPart
+from mail2cospend.syncstate import SyncState
+
+
+# The compat32 policy leaves the headers undecoded until they are read, policy.default parses every header of
+# every part with its header registry and made the mime stage of the benchmark more than twice as slow
+_message_parser = BytesParser()
+
+
+# Runs one combined search for all adapters on the mail server and routes each mail
+# to the adapter(s) whose FROM/SUBJECT criteria match its headers.
+class SearchDispatcher:
+
+    def __init__(self, config: Config, imap: imaplib.IMAP4_SSL, adapters: List[SearchAdapter],
+                 published_ids: PublishedIdStore, sync_state: Optional[SyncState] = None,
+                 parse_cache: Optional[ParseCache] = None, pdf_executor: Optional[Executor] = None):
+        self.config = config
+        self.imap = imap
+        self.adapters = adapters
+        self.published_ids = published_ids
+        self.sync_state = sync_state
+        self.parse_cache = parse_cache
+        self.pdf_executor = pdf_executor
+        # Throughput counters of the last search
+        self.searched_mails = 0
+        self.fetched_bytes = 0
+        # The UIDNEXT of each searched mailbox, so waiting for new mails (IDLE) notices the mails of the meantime
+        self.uidnexts: Dict[str, Optional[int]] = dict()
+        self._stats_lock = threading.Lock()
+
+    def _get_uidvalidity(self, mailbox: str) -> int:
+        typ, data = self.imap.response('UIDVALIDITY')
+        if data and data[0] is not None:
+            return int(data[0])
+        typ, data = self.imap.status(mailbox, '(UIDVALIDITY)')
+        return int(data[0].split(b'UIDVALIDITY')[1].strip(b' ()'))
+
+    def _get_window_start(self, mailbox: str, adapter: SearchAdapter) -> Optional[datetime]:
+        # The mails received before the newest processed one were handled in an earlier cycle. The margin covers
+        # mails which are stored late (e.g. sorted by a client) and the time zone of the server's SINCE.
+        if self.sync_state is None or self.config.imap_search_window_days == 0:
+            return None
+        last_date = self.sync_state.get_last_date(mailbox, adapter.adapter_name())
+        if last_date is None:
+            return None
+        start = last_date - timedelta(days=self.config.imap_search_window_days)
+        if start <= self.config.get_since_datetime():
+            return None
+        return start
+
+    def _build_search_query(self, adapters: List[SearchAdapter], last_uid: int,
+                            window_starts: Dict[str, Optional[datetime]]) -> str:
+        # Each adapter searches from the start of its own window, the SINCE of its query is the lower bound
+        queries = []
+        for adapter in adapters:
+            window_start = window_starts.get(adapter.adapter_name())
+            if window_start is None:
+                queries.append(f'({adapter._search_query})')
+            else:
+                queries.append(f'({adapter._search_query} (SINCE "{window_start.strftime("%d-%b-%Y")}"))')
+        # IMAP "OR" takes exactly two keys: OR (a) OR (b) (c)
+        search_query = queries[-1]
+        for query in reversed(queries[:-1]):
+            search_query = f'OR {query} {search_query}'
+        if last_uid > 0:
+            search_query = f'(UID {last_uid + 1}:*) {search_query}'
+        if self.config.before is not None:
+            search_query = f'{search_query} (BEFORE "{self.config.get_before_for_imap_query()}")'
+        return search_query
+
+    def _fetch(self, imap: imaplib.IMAP4_SSL, uids: List[int], items: str) -> Dict[int, Dict[str, object]]:
+        kind = 'full' if 'RFC822' in items else 'structure' if 'BODYSTRUCTURE' in items else 'parts'
+        with metrics.FETCH_SECONDS.labels(items=kind).time():
+            fetched = uid_fetch(imap, uids, items)
+        size = sum(len(value) for mail in fetched.values() for value in mail.values() if isinstance(value, bytes))
+        metrics.FETCHED_BYTES.inc(size)
+        with self._stats_lock:
+            self.fetched_bytes += size
+        return fetched
+
+    def _matching_adapters(self, uid: int, from_header: str, subject_header: str,
+                           last_uids: Dict[str, int]) -> List[SearchAdapter]:
+        return [adapter for adapter in self.adapters
+                if adapter.adapter_name() in last_uids and uid > last_uids[adapter.adapter_name()]
+                and adapter.matches(from_header, subject_header)]
+
+    def _parse(self, mailbox: str, uids: List[int], last_uids: Dict[str, int]) -> Iterator[
+        Tuple[int, SearchAdapter, Optional[BonSummary], Optional[datetime]]]:
+        # Request the mails in batches and hand them to the adapters batch by batch
+        batch_size = self.config.imap_fetch_batch_size
+        batches = [uids[start:start + batch_size] for start in range(0, len(uids), batch_size)]
+        if self.config.imap_connections == 1 or len(batches) < 2:
+            for batch in batches:
+                yield from self._parse_batch(self.imap, batch, last_uids)
+            return
+
+        # Fetch and parse several batches at once, each worker with its own connection. The results are
+        # yielded in the order of the batches, so the outcome does not depend on which worker finishes first.
+        # At most two batches per worker are requested ahead, so the memory does not grow with the backlog.
+        pool = ImapConnectionPool(self.config, mailbox)
+        window = 2 * self.config.imap_connections
+        try:
+            with ThreadPoolExecutor(max_workers=self.config.imap_connections) as executor:
+                futures = deque()
+                for batch in batches:
+                    futures.append(executor.submit(self._parse_batch_pooled, pool, batch, last_uids))
+                    if len(futures) >= window:
+                        yield from futures.popleft().result()
+                while futures:
+                    yield from futures.popleft().result()
+        finally:
+            pool.close()
+
+    def _parse_batch_pooled(self, pool: ImapConnectionPool, uids: List[int], last_uids: Dict[str, int]) -> List[
+        Tuple[int, SearchAdapter, Optional[BonSummary], Optional[datetime]]]:
+        with pool.connection() as imap:
+            return list(self._parse_batch(imap, uids, last_uids))
+
+    def _parse_batch(self, imap: imaplib.IMAP4_SSL, uids: List[int], last_uids: Dict[str, int]) -> Iterator[
+        Tuple[int, SearchAdapter, Optional[BonSummary], Optional[datetime]]]:
+        if self.config.imap_fetch_mode == 'partial':
+            return self._parse_partial(imap, uids, last_uids)
+        return self._parse_full(imap, uids, last_uids)
+
+    def _parse_full(self, imap: imaplib.IMAP4_SSL, uids: List[int], last_uids: Dict[str, int]) -> Iterator[
+        Tuple[int, SearchAdapter, Optional[BonSummary], Optional[datetime]]]:
+        fetched = self._fetch(imap, uids, '(UID RFC822 INTERNALDATE)')
+        for uid in uids:
+            if uid not in fetched:
+                continue
+            mail = fetched.pop(uid)
+            raw_email = mail['RFC822']
+            received = parse_internaldate(mail.get('INTERNALDATE'))
+            # The headers decide which adapters get the mail, the body is only parsed if one of them needs it
+            headers = _message_parser.parsebytes(_header_block(raw_email), headersonly=True)
+            adapters = self._matching_adapters(uid, decode_mime_header(headers['from']),
+                                               decode_mime_header(headers['subject']), last_uids)
+            if len(adapters) == 0:
+                continue
+            try:
+                email_timestamp = utils.parsedate_to_datetime(headers['date']).replace(tzinfo=None)
+            except (TypeError, ValueError):
+                logging.warning(f"Skipping the mail with UID {uid}, it has no valid date header")
+                continue
+            cache_key = get_cache_key(headers['message-id'], [raw_email])
+            message: List[Message] = []
+            for adapter in adapters:
+                bon = self._parse_cached(cache_key, adapter, email_timestamp,
+                                         lambda: adapter.parse_message(_parse_once(raw_email, message),
+                                                                       email_timestamp, self.pdf_executor))
+                yield uid, adapter, bon, received
+                if bon is not None:
+                    break
+
+    def _parse_partial(self, imap: imaplib.IMAP4_SSL, uids: List[int], last_uids: Dict[str, int]) -> Iterator[
+        Tuple[int, SearchAdapter, Optional[BonSummary], Optional[datetime]]]:
+        # Only request the envelope and the structure of the mails, then fetch the parts the adapters use
+        fetched = self._fetch(imap, uids, '(UID ENVELOPE BODYSTRUCTURE INTERNALDATE)')
+        candidates = dict()
+        uids_by_sections = dict()
+        for uid in uids:
+            if uid not in fetched:
+                continue
+            envelope = parse_envelope(fetched[uid]['ENVELOPE'])
+            adapters = self._matching_adapters(uid, envelope.from_, envelope.subject, last_uids)
+            if len(adapters) == 0:
+                continue
+            try:
+                email_timestamp = utils.parsedate_to_datetime(envelope.date).replace(tzinfo=None)
+            except (TypeError, ValueError):
+                logging.warning(f"Skipping the mail with UID {uid}, it has no valid date header")
+                continue
+            parts = parse_bodystructure(fetched[uid]['BODYSTRUCTURE'])
+            # Mails known from the parse cache do not need to be downloaded again
+            cached = dict()
+            if self.parse_cache is not None and envelope.message_id:
+                for adapter in adapters:
+                    hit, bon = self.parse_cache.get(get_cache_key(envelope.message_id), adapter.adapter_name())
+                    if hit:
+                        cached[adapter.adapter_name()] = bon
+                        metrics.PARSE_CACHE_HITS.labels(adapter=adapter.adapter_name()).inc()
+            wanted_parts = [part for part in parts
+                            if any(adapter.is_wanted_part(part.content_type, part.filename) for adapter in adapters
+                                   if adapter.adapter_name() not in cached)]
+            received = parse_internaldate(fetched[uid].get('INTERNALDATE'))
+            candidates[uid] = (email_timestamp, received, envelope.message_id, adapters, cached, wanted_parts)
+            if len(wanted_parts) > 0:
+                sections = tuple(part.section for part in wanted_parts)
+                uids_by_sections.setdefault(sections, list()).append(uid)
+
+        # FETCH requests the same items for every mail of the set, so group the mails by their wanted sections
+        bodies = dict()
+        for sections, section_uids in uids_by_sections.items():
+            items = " ".join(f"BODY.PEEK[{section}]" for section in sections)
+            bodies.update(self._fetch(imap, section_uids, f'(UID {items})'))
+
+        for uid, candidate in candidates.items():
+            email_timestamp, received, message_id, adapters, cached, wanted_parts = candidate
+            uid_bodies = bodies.pop(uid, dict())
+            payloads = [(part, uid_bodies[f"BODY[{part.section}]"]) for part in wanted_parts
+                        if f"BODY[{part.section}]" in uid_bodies]
+            cache_key = get_cache_key(message_id, [payload for _, payload in payloads])
+            for adapter in adapters:
+                if adapter.adapter_name() in cached:
+                    bon = cached[adapter.adapter_name()]
+                else:
+                    bon = self._parse_cached(cache_key, adapter, email_timestamp,
+                                             lambda: self._parse_parts(adapter, payloads, email_timestamp))
+                yield uid, adapter, bon, received
+                if bon is not None:
+                    break
+
+    def _parse_parts(self, adapter: SearchAdapter, payloads: List[Tuple[BodyPart, bytes]],
+                     email_timestamp: datetime) -> Optional[BonSummary]:
+        parts = [MailPart(content_type=part.content_type, filename=part.filename, charset=part.params.get('charset'),
+                          load=functools.partial(part.decode, payload)) for part, payload in payloads]
+        return adapter.parse_parts(parts, email_timestamp, self.pdf_executor)
+
+    def _parse_cached(self, cache_key: str, adapter: SearchAdapter, email_timestamp: datetime,
+                      parse: Callable[[], Optional[BonSummary]]) -> Optional[BonSummary]:
+        if self.parse_cache is None:
+            with metrics.PARSE_SECONDS.labels(adapter=adapter.adapter_name()).time():
+                return parse()
+        hit, bon = self.parse_cache.get(cache_key, adapter.adapter_name())
+        if hit:
+            logging.debug(f"Using the cached parse result of {cache_key} ({adapter.adapter_name()})")
+            metrics.PARSE_CACHE_HITS.labels(adapter=adapter.adapter_name()).inc()
+            return bon
+        with metrics.PARSE_SECONDS.labels(adapter=adapter.adapter_name()).time():
+            bon = parse()
+        self.parse_cache.put(cache_key, adapter.adapter_name(), email_timestamp, bon)
+        return bon
+
+    def search(self) -> Iterator[BonSummary]:
+        # Yields each unpublished bon as soon as it is parsed
+        if len(self.adapters) == 0:
+            return
+        self.searched_mails = 0
+        # Adapters with a dedicated folder are searched there, all others in the inbox
+        mailboxes: Dict[str, List[SearchAdapter]] = dict()
+        for adapter in self.adapters:
+            mailboxes.setdefault(adapter.get_mailbox(), list()).append(adapter)
+        found = 0
+        try:
+            for mailbox, adapters in mailboxes.items():
+                for bon in self._search_mailbox(mailbox, adapters):
+                    found += 1
+                    yield bon
+        finally:
+            if self.parse_cache is not None:
+                self.parse_cache.evict_before(self.config.get_since_datetime())
+                self.parse_cache.commit()
+        logging.debug(f"Found {found} bons")
+
+    def _search_mailbox(self, mailbox: str, adapters: List[SearchAdapter]) -> Iterator[BonSummary]:
+        adapter_names = ", ".join(adapter.adapter_name() for adapter in adapters)
+        logging.info(f"Requesting {adapter_names} from the mail server ({mailbox})")
+        typ, data = self.imap.select(mailbox)
+        if typ != 'OK':
+            logging.error(f"Can not select the mailbox '{mailbox}' of {adapter_names}: {data}")
+            return
+        self.uidnexts[mailbox] = get_uidnext(self.imap)
+        last_uids = {adapter.adapter_name(): 0 for adapter in adapters}
+        window_starts = dict()
+        if self.sync_state is not None:
+            uidvalidity = self._get_uidvalidity(mailbox)
+            for adapter in adapters:
+                last_uids[adapter.adapter_name()] = self.sync_state.get_last_uid(
+                    mailbox, adapter.adapter_name(), uidvalidity, self.config.since)
+                window_starts[adapter.adapter_name()] = self._get_window_start(mailbox, adapter)
+        min_last_uid = min(last_uids.values())
+        search_query = self._build_search_query(adapters, min_last_uid, window_starts)
+        logging.debug(f" search for: {search_query}")
+        with metrics.SEARCH_SECONDS.time():
+            typ, data = self.imap.uid('SEARCH', None, search_query)
+        # "UID n:*" always matches the mail with the highest UID, even if it is lower than n
+        uids = [int(uid) for uid in data[0].split() if int(uid) > min_last_uid]
+        self.searched_mails += len(uids)
+        for uid, adapter, bon, received in self._parse(mailbox, uids, last_uids):
+            unpublished_id = None
+            if bon is not None and bon.get_id() in self.published_ids:
+                logging.debug(f"Skipping ID {bon.get_id()} ({adapter.adapter_name()}), already published!")
+            elif bon is not None:
+                unpublished_id = bon.get_id()
+                metrics.BONS_FOUND.labels(adapter=adapter.adapter_name()).inc()
+            if self.sync_state is not None:
+                self.sync_state.track(mailbox, adapter.adapter_name(), uid, unpublished_id, received)
+            if unpublished_id is not None:
+                yield bon
+
+
+def _parse_once(raw_email: bytes, parsed: List[Message]) -> Message:
+    # Several adapters may parse the same mail, the MIME tree is built for the first of them
+    if len(parsed) == 0:
+        parsed.append(_message_parser.parsebytes(raw_email))
+    return parsed[0]
+
+
+def _header_block(raw_email: bytes) -> bytes:
+    # The headers up to the first empty line, parsing the whole mail with headersonly=True still reads all of it
+    end = raw_email.find(b'\r\n\r\n')
+    if end != -1:
+        return raw_email[:end + 4]
+    end = raw_email.find(b'\n\n')
+    return raw_email if end == -1 else raw_email[:end + 2]
@@ -0,0 +1,33 @@
+import threading
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+# A requests session with keep-alive connections, a sized connection pool per host and a default timeout.
+class PooledSession(requests.Session):
+
+    def __init__(self, timeout: float, pool_size: int):
+        super().__init__()
+        self.timeout = timeout
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+_session: Optional[PooledSession] = None
+_session_lock = threading.Lock()
+
+
+def get_http_session(timeout: float, pool_size: int) -> PooledSession:
+    # One session for the whole process, shared by the cospend and ntfy requests
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = PooledSession(timeout, pool_size)
+        return _session
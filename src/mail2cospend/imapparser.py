@@ -0,0 +1,211 @@
+import base64
+import dataclasses
+import quopri
+from datetime import datetime, timezone
+from email.header import decode_header, make_header
+from typing import Dict, List, Optional, Tuple, Union
+
+_ATOM_END = (b'(', b')', b' ', b'\r', b'\n')
+
+
+# Parses IMAP syntax (atoms, quoted strings, literals, NIL and parenthesized lists) into nested lists.
+# Atoms and strings are returned as bytes, NIL as None.
+def parse(data: Union[bytes, str]) -> list:
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    result, _ = _parse_list(data, 0, closing=False)
+    return result
+
+
+def _parse_list(data: bytes, pos: int, closing: bool) -> Tuple[list, int]:
+    result = []
+    length = len(data)
+    while pos < length:
+        char = data[pos:pos + 1]
+        if char in (b' ', b'\r', b'\n'):
+            pos += 1
+        elif char == b'(':
+            value, pos = _parse_list(data, pos + 1, closing=True)
+            result.append(value)
+        elif char == b')':
+            if closing:
+                return result, pos + 1
+            pos += 1
+        elif char == b'"':
+            value, pos = _parse_quoted(data, pos + 1)
+            result.append(value)
+        elif char == b'{':
+            value, pos = _parse_literal(data, pos + 1)
+            result.append(value)
+        else:
+            value, pos = _parse_atom(data, pos)
+            result.append(None if value.upper() == b'NIL' else value)
+    return result, pos
+
+
+def _parse_quoted(data: bytes, pos: int) -> Tuple[bytes, int]:
+    value = bytearray()
+    while pos < len(data):
+        char = data[pos:pos + 1]
+        if char == b'\\':
+            value += data[pos + 1:pos + 2]
+            pos += 2
+        elif char == b'"':
+            return bytes(value), pos + 1
+        else:
+            value += char
+            pos += 1
+    return bytes(value), pos
+
+
+def _parse_literal(data: bytes, pos: int) -> Tuple[bytes, int]:
+    end = data.index(b'}', pos)
+    size = int(data[pos:end])
+    pos = end + 1
+    if data[pos:pos + 2] == b'\r\n':
+        pos += 2
+    return data[pos:pos + size], pos + size
+
+
+def _parse_atom(data: bytes, pos: int) -> Tuple[bytes, int]:
+    start = pos
+    # Section specifiers like BODY[1.2] or BODY[HEADER.FIELDS (FROM)] belong to the atom
+    depth = 0
+    while pos < len(data):
+        char = data[pos:pos + 1]
+        if char == b'[':
+            depth += 1
+        elif char == b']':
+            depth -= 1
+        elif depth == 0 and char in _ATOM_END:
+            break
+        pos += 1
+    return data[start:pos], pos
+
+
+def join_response(data: List[Union[bytes, tuple]]) -> bytes:
+    # imaplib splits responses with literals into (line, literal) tuples, join them back into one stream
+    result = bytearray()
+    for item in data:
+        if isinstance(item, tuple):
+            result += item[0] + b'\r\n' + item[1]
+        elif item is not None:
+            result += item + b'\r\n'
+    return bytes(result)
+
+
+@dataclasses.dataclass(frozen=True)
+class Envelope:
+    date: Optional[str]
+    subject: str
+    from_: str
+    message_id: Optional[str]
+
+
+@dataclasses.dataclass(frozen=True)
+class BodyPart:
+    section: str
+    content_type: str
+    params: Dict[str, str]
+    encoding: str
+    size: int
+    filename: Optional[str]
+
+    def decode(self, data: bytes) -> bytes:
+        if self.encoding == 'base64':
+            return base64.b64decode(data)
+        if self.encoding == 'quoted-printable':
+            return quopri.decodestring(data)
+        return data
+
+
+def parse_fetch_response(data: List[Union[bytes, tuple]]) -> Dict[int, Dict[str, object]]:
+    # "<seq> (UID <uid> <item> <value> ...)" for each mail -> {uid: {item: value}}
+    result = dict()
+    tokens = parse(join_response(data))
+    for token in tokens:
+        if not isinstance(token, list):
+            continue
+        items = {_decode(token[i]).upper(): token[i + 1] for i in range(0, len(token) - 1, 2)}
+        if 'UID' in items:
+            result[int(items.pop('UID'))] = items
+    return result
+
+
+def parse_envelope(envelope: list) -> Envelope:
+    date, subject, from_ = envelope[0], envelope[1], envelope[2]
+    addresses = []
+    for name, _, mailbox, host in from_ or []:
+        address = f"{_decode(mailbox)}@{_decode(host)}"
+        addresses.append(f"{decode_mime_header(name)} <{address}>" if name else address)
+    return Envelope(date=_decode(date) if date else None,
+                    subject=decode_mime_header(subject),
+                    from_=", ".join(addresses),
+                    message_id=_decode(envelope[9]) if envelope[9] else None)
+
+
+def parse_internaldate(value: Optional[bytes]) -> Optional[datetime]:
+    # The date the server received the mail ("17-Jul-1996 02:44:25 -0700") as naive UTC datetime
+    try:
+        received = datetime.strptime(_decode(value).strip(), '%d-%b-%Y %H:%M:%S %z')
+    except ValueError:
+        return None
+    return received.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def parse_bodystructure(structure: list, section: str = '') -> List[BodyPart]:
+    if isinstance(structure[0], list):
+        # Multipart: the sub parts are followed by the subtype and the extension data
+        parts = []
+        index = 1
+        for child in structure:
+            if not isinstance(child, list):
+                break
+            parts += parse_bodystructure(child, f"{section}.{index}" if section else str(index))
+            index += 1
+        return parts
+    content_type = f"{_decode(structure[0])}/{_decode(structure[1])}".lower()
+    params = _parse_params(structure[2])
+    # The disposition follows the type specific fields and the MD5 extension field
+    if content_type.startswith('text/'):
+        disposition_index = 9
+    elif content_type == 'message/rfc822':
+        disposition_index = 11
+    else:
+        disposition_index = 8
+    filename = None
+    if len(structure) > disposition_index and isinstance(structure[disposition_index], list):
+        disposition = structure[disposition_index]
+        if len(disposition) > 1:
+            filename = _parse_params(disposition[1]).get('filename')
+    filename = filename or params.get('name')
+    return [BodyPart(section=section or '1',
+                     content_type=content_type,
+                     params=params,
+                     encoding=_decode(structure[5] or b'7bit').lower(),
+                     size=int(structure[6] or 0),
+                     filename=decode_mime_header(filename) if filename else None)]
+
+
+def _parse_params(params: Optional[list]) -> Dict[str, str]:
+    if not isinstance(params, list):
+        return dict()
+    return {_decode(params[i]).lower(): _decode(params[i + 1]) for i in range(0, len(params) - 1, 2)}
+
+
+def _decode(value: Optional[bytes]) -> str:
+    if value is None:
+        return ""
+    return value.decode('utf-8', errors='replace')
+
+
+def decode_mime_header(value: Optional[Union[bytes, str]]) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, bytes):
+        value = _decode(value)
+    # Resolve MIME encoded words like "=?utf-8?q?...?="
+    try:
+        return str(make_header(decode_header(value)))
+    except (ValueError, LookupError):
+        return value
@@ -1,7 +1,14 @@
 import imaplib
-from typing import Optional
+import queue
+import select
+import ssl
+import time
+from contextlib import contextmanager
+from typing import Optional, Dict, Iterable, Iterator
 
+from mail2cospend import metrics
 from mail2cospend.config import Config
+from mail2cospend.imapparser import parse_fetch_response
 import logging
 
 
@@ -10,8 +17,11 @@ def _try_connect_imap(config) -> imaplib.IMAP4_SSL:
     imap_user = config.imap_user
     imap_pass = config.imap_password
     imap_port = config.imap_port
-    # connect to host using SSL
-    imap = imaplib.IMAP4_SSL(imap_host, imap_port)
+    # connect to host using SSL (plain connections only for local test servers)
+    if config.imap_ssl:
+        imap = imaplib.IMAP4_SSL(imap_host, imap_port)
+    else:
+        imap = imaplib.IMAP4(imap_host, imap_port)
     # login to server
     imap.login(imap_user, imap_pass)
     return imap
@@ -25,7 +35,8 @@ def get_imap_connection(config: Config) -> Optional[imaplib.IMAP4_SSL]:
         if config.exit_event.is_set():
             break
         try:
-            imap = _try_connect_imap(config)
+            with metrics.IMAP_CONNECT_SECONDS.time():
+                imap = _try_connect_imap(config)
             return imap
         except:
             logging.error("No connection to the imap server.")
@@ -36,3 +47,130 @@ def get_imap_connection(config: Config) -> Optional[imaplib.IMAP4_SSL]:
             logging.error("Exited: No connection to the imap server.")
             break
     return None
+
+
+def to_uid_set(uids: Iterable[int]) -> str:
+    # Compress consecutive UIDs into ranges: [1, 2, 3, 7] -> "1:3,7"
+    ranges = []
+    for uid in sorted(set(uids)):
+        if ranges and ranges[-1][1] == uid - 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ",".join(str(start) if start == end else f"{start}:{end}" for start, end in ranges)
+
+
+def uid_fetch(imap: imaplib.IMAP4_SSL, uids: Iterable[int], items: str) -> Dict[int, Dict[str, object]]:
+    typ, data = imap.uid('FETCH', to_uid_set(uids), items)
+    if typ != 'OK':
+        raise imaplib.IMAP4.error(f"FETCH failed: {data}")
+    return parse_fetch_response(data)
+
+
+def _has_pending_data(imap: imaplib.IMAP4_SSL) -> bool:
+    # imaplib reads through a buffered file and SSL sockets may hold already decrypted data, neither is reported
+    # by select(). With the socket switched to non-blocking, peek() returns the buffered data or reads the data
+    # which has arrived, without waiting for more.
+    sock = imap.sock
+    timeout = sock.gettimeout()
+    sock.setblocking(False)
+    try:
+        return len(imap.file.peek()) > 0
+    except (ssl.SSLWantReadError, BlockingIOError):
+        return False
+    finally:
+        sock.settimeout(timeout)
+
+
+def supports_idle(imap: imaplib.IMAP4_SSL) -> bool:
+    return 'IDLE' in imap.capabilities
+
+
+def get_uidnext(imap: imaplib.IMAP4_SSL) -> Optional[int]:
+    # The UIDNEXT of the last SELECT, i.e. the UID of the next mail which arrives in the selected mailbox
+    typ, data = imap.response('UIDNEXT')
+    if data and data[-1] is not None:
+        return int(data[-1])
+    return None
+
+
+def wait_for_new_mails(imap: imaplib.IMAP4_SSL, config: Config, timeout: Optional[float] = None,
+                       uidnext: Optional[int] = None) -> bool:
+    # Runs one IMAP IDLE session (RFC 2177) on the inbox. Returns True if the server announced new mails
+    # and False if the session ended after `timeout` (default IMAP_IDLE_TIMEOUT) seconds or because the
+    # program is exiting. `uidnext` is the UIDNEXT of the inbox when the last cycle searched it.
+    imap.select(config.imap_inbox)
+    # IDLE only reports the mails which arrive after it started, not those since the search of the cycle
+    current_uidnext = get_uidnext(imap)
+    if uidnext is not None and current_uidnext is not None and current_uidnext > uidnext:
+        logging.debug("New mails arrived since the last search")
+        return True
+    tag = imap._new_tag()
+    imap.send(tag + b' IDLE\r\n')
+    response = imap.readline()
+    if not response.startswith(b'+'):
+        raise imaplib.IMAP4.error(f"IDLE failed: {response}")
+    logging.debug("Waiting for new mails (IDLE)")
+    new_mails = False
+    deadline = time.monotonic() + (config.imap_idle_timeout if timeout is None else timeout)
+    while not new_mails and not config.exit_event.is_set() and time.monotonic() < deadline:
+        # Wake up every second to react on the exit event
+        if not _has_pending_data(imap):
+            readable, _, _ = select.select([imap.sock], [], [], 1)
+            if not readable:
+                continue
+        line = imap.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("Connection closed by the imap server")
+        if line.startswith(b'* ') and (line.rstrip().endswith(b'EXISTS') or line.rstrip().endswith(b'RECENT')):
+            new_mails = True
+    imap.send(b'DONE\r\n')
+    while True:
+        line = imap.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("Connection closed by the imap server")
+        if line.startswith(tag):
+            break
+    return new_mails
+
+
+# Opens additional authenticated connections on demand (at most one per worker), each with the mailbox (default:
+# the inbox) selected read-only, so several batches of mails can be fetched at once.
+class ImapConnectionPool:
+
+    def __init__(self, config: Config, mailbox: Optional[str] = None):
+        self.config = config
+        self.mailbox = mailbox or config.imap_inbox
+        self._idle: queue.SimpleQueue = queue.SimpleQueue()
+
+    def _open(self) -> imaplib.IMAP4_SSL:
+        imap = get_imap_connection(self.config)
+        if imap is None:
+            raise imaplib.IMAP4.abort("No connection to the imap server")
+        imap.select(self.mailbox, readonly=True)
+        return imap
+
+    @contextmanager
+    def connection(self) -> Iterator[imaplib.IMAP4_SSL]:
+        try:
+            imap = self._idle.get_nowait()
+        except queue.Empty:
+            imap = self._open()
+        try:
+            yield imap
+        except BaseException:
+            # The state of a connection which failed (or was interrupted) in the middle of a command is unknown
+            _logout(imap)
+            raise
+        self._idle.put(imap)
+
+    def close(self):
+        while not self._idle.empty():
+            _logout(self._idle.get_nowait())
+
+
+def _logout(imap: imaplib.IMAP4_SSL):
+    try:
+        imap.logout()
+    except (imaplib.IMAP4.error, OSError):
+        pass
@@ -1,17 +1,31 @@
+import imaplib
 import logging
-from threading import Event
+import multiprocessing
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from threading import Event, Thread
+from typing import List, Optional
 
 import click
+import requests
 
-from mail2cospend.config import load_config, Config
-from mail2cospend.cospendconnector import publish_bongs, test_connection, get_cospend_project_infos
-from mail2cospend.mailconnector import get_imap_connection
-from mail2cospend.searchadapter import all_search_adapters
+from mail2cospend import metrics
+from mail2cospend.config import load_config, load_accounts, Config
+from mail2cospend.cospendconnector import publish_bongs, test_connection, get_cospend_project_infos, \
+    get_project_infos_cache
+from mail2cospend.dispatcher import SearchDispatcher
+from mail2cospend.mailconnector import get_imap_connection, supports_idle, wait_for_new_mails
+from mail2cospend.outbox import Outbox
+from mail2cospend.parsecache import ParseCache
+from mail2cospend.profiling import profiler
+from mail2cospend.publishedids import PublishedIdStore
+from mail2cospend.searchadapter import get_adapter_names, load_adapter_class, SearchAdapter
+from mail2cospend.syncstate import SyncState
 
 exit_event = Event()
 
 
-def _init() -> Config:
+def init() -> Config:
     config = load_config(exit_event)
 
     if not test_connection(config):
@@ -19,45 +33,196 @@ def _init() -> Config:
     return config
 
 
-def run(dry=False):
-    config = _init()
-    logging.debug("Enabled adapters:")
-    for adapter in all_search_adapters:
-        if config.is_adapter_enabled(adapter.adapter_name()):
-            logging.debug(f"  - {adapter.adapter_name()}")
+def run(dry=False, profile_cycles: int = 0):
+    config = init()
+    metrics.enable(config.metrics_port)
+    profiler.request(profile_cycles or config.profile_cycles)
+    accounts = load_accounts(config)
+    validate_cospend_ids(config, load_adapters(config), dry)
+    # The stores, the PDF worker processes and the HTTP session are shared by all accounts
+    parse_cache = ParseCache()
+    published_ids = PublishedIdStore.from_config(config)
+    outbox = Outbox.from_config(config)
+    pdf_executor = create_pdf_executor(config)
 
-    while not exit_event.is_set():
-        imap = get_imap_connection(config)
-        if imap is None or exit_event.is_set():
+    if len(accounts) == 1:
+        run_account(accounts[0], parse_cache, published_ids, outbox, pdf_executor, dry)
+    else:
+        # Each account searches (or waits with IDLE) on its own connection and schedule
+        threads = [Thread(target=_run_account_thread, name=account.account_name,
+                          args=(account, parse_cache, published_ids, outbox, pdf_executor, dry))
+                   for account in accounts]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if exit_event.is_set():
             exit(1)
+    if pdf_executor is not None:
+        pdf_executor.shutdown()
+
+
+def create_pdf_executor(config: Config) -> Optional[ProcessPoolExecutor]:
+    if config.parse_processes <= 0:
+        return None
+    # Forking a process with running threads (account threads, metrics server, connection pool) can copy held locks
+    # into the worker, so the workers are started from a clean server process (or spawned where there is none)
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return ProcessPoolExecutor(max_workers=config.parse_processes, mp_context=multiprocessing.get_context(method))
+
+
+def _run_account_thread(*args):
+    try:
+        run_account(*args)
+    except BaseException:
+        # An account which stops (shut down or server lost) stops all of them, like a single account ends the process
+        exit_event.set()
+        raise
 
-        bons = list()
-        for Adapter_cls in all_search_adapters:
-            if config.is_adapter_enabled(Adapter_cls.adapter_name()):
-                adapter = Adapter_cls(config, imap)
-                this_bons = adapter.search()
-                bons += this_bons
-                imap.close()
-        imap.shutdown()
 
+def run_account(config: Config, parse_cache: ParseCache, published_ids: PublishedIdStore, outbox: Outbox,
+                pdf_executor: Optional[Executor], dry=False):
+    if config.account_name is not None:
+        logging.info(f"Searching the account '{config.account_name}' ({config.imap_user}@{config.imap_host})")
+    adapters = load_adapters(config)
+    sync_state = SyncState.from_config(config)
+
+    imap = None
+    use_idle = config.imap_idle and not dry
+    while not exit_event.is_set():
+        if imap is None:
+            imap = get_imap_connection(config)
+            if imap is None or exit_event.is_set():
+                exit(1)
+            if use_idle and not supports_idle(imap):
+                logging.warning(f"The imap server does not support IDLE, polling every {config.interval} seconds")
+                use_idle = False
+
+        with profiler.cycle():
+            cycle_start = time.perf_counter()
+            try:
+                dispatcher = SearchDispatcher(config, imap, adapters, published_ids, sync_state, parse_cache,
+                                              pdf_executor)
+                if dry:
+                    logging.info("Dry run. Results:")
+                search_and_enqueue(config, dispatcher, outbox, published_ids, dry)
+            except (imaplib.IMAP4.abort, OSError):
+                logging.error("Lost the connection to the imap server, reconnecting.")
+                imap = None
+                continue
+            if not use_idle:
+                close_imap_connection(imap, adapters)
+                imap = None
+
+            if exit_event.is_set():
+                exit(1)
+
+            if dry:
+                break
+            else:
+                finish_cycle(config, sync_state, outbox, published_ids, cycle_start)
         if exit_event.is_set():
             exit(1)
+        # Wake up early if a retry of the outbox is due before the next regular cycle
+        next_retry = outbox.seconds_until_next_attempt()
+        if use_idle:
+            try:
+                wait_for_new_mails(imap, config, get_idle_timeout(config, adapters, next_retry),
+                                   dispatcher.uidnexts.get(config.imap_inbox))
+            except (imaplib.IMAP4.abort, OSError):
+                logging.error("Lost the connection to the imap server, reconnecting.")
+                imap = None
+        else:
+            wait = config.interval if next_retry is None else min(config.interval, next_retry)
+            logging.info(f"Waiting {int(wait)} seconds before next run")
+            exit_event.wait(wait)
+    if imap is not None:
+        close_imap_connection(imap, adapters)
+
+
+def get_idle_timeout(config: Config, adapters: List[SearchAdapter], next_retry: Optional[float] = None) -> float:
+    timeout = config.imap_idle_timeout
+    # IDLE only watches the inbox, the other folders of the adapters are still searched every INTERVAL seconds
+    if any(adapter.get_mailbox() != config.imap_inbox for adapter in adapters):
+        timeout = min(timeout, config.interval)
+    if next_retry is not None:
+        timeout = min(timeout, next_retry)
+    return timeout
 
+
+def search_and_enqueue(config: Config, dispatcher: SearchDispatcher, outbox: Outbox, published_ids: PublishedIdStore,
+                       dry=False) -> int:
+    # Each bon is handed over as soon as it is parsed, in bulk mode as soon as there is one per worker. Returns the
+    # number of found bons.
+    found = 0
+    bons = list()
+    for bon in dispatcher.search():
+        found += 1
         if dry:
-            logging.info("Dry run. Results:")
-            for bon in bons:
-                logging.info(bon)
-            break
-        else:
-            publish_bongs(bons, config)
-        if exit_event.is_set():
-            exit(1)
-        logging.info(f"Waiting {config.interval} seconds before next run")
-        exit_event.wait(config.interval)
+            logging.info(bon)
+            continue
+        bons.append(bon)
+        if len(bons) >= config.publish_concurrency:
+            outbox.enqueue(bons)
+            bons.clear()
+            publish_bongs(outbox, config, published_ids)
+    outbox.enqueue(bons)
+    return found
+
+
+def finish_cycle(config: Config, sync_state: SyncState, outbox: Outbox, published_ids: PublishedIdStore,
+                 cycle_start: float, publish: bool = True):
+    # The bookkeeping once every bon of a cycle is in the outbox, for the sync and the async engine. Once a bon is in
+    # the outbox it is retried from there, so the mail does not need to be searched again.
+    sync_state.commit(outbox)
+    if publish:
+        publish_bongs(outbox, config, published_ids)
+    published_ids.flush()
+    outbox.evict_done_before(config.get_since_datetime())
+    metrics.CYCLE_SECONDS.observe(time.perf_counter() - cycle_start)
+
+
+def validate_cospend_ids(config: Config, adapters: List[SearchAdapter], dry: bool = False):
+    # Checks the configured payer, payed for, category and payment mode ids once against the project
+    project_infos = get_project_infos_cache(config)
+    try:
+        errors = project_infos.validate(adapter.adapter_name() for adapter in adapters)
+    except (requests.RequestException, ValueError) as e:
+        logging.warning(f"Could not load the cospend project infos to check the configured ids: {e}")
+        errors = []
+    for error in errors:
+        logging.error(f"Invalid cospend configuration: {error}")
+    if len(errors) > 0 and not dry:
+        exit(1)
+    project_infos.start_background_refresh()
+
+
+def load_adapters(config: Config) -> List[SearchAdapter]:
+    logging.debug("Enabled adapters:")
+    adapters = list()
+    for adapter_name in get_adapter_names():
+        if config.is_adapter_enabled(adapter_name):
+            try:
+                Adapter_cls = load_adapter_class(adapter_name)
+            except Exception as e:
+                logging.error(f"Could not load the adapter '{adapter_name}': {e}")
+                exit(1)
+            logging.debug(f"  - {adapter_name}")
+            adapters.append(Adapter_cls(config))
+    return adapters
+
+
+def close_imap_connection(imap: imaplib.IMAP4_SSL, adapters: List[SearchAdapter]):
+    try:
+        if len(adapters) > 0:
+            imap.close()
+        imap.shutdown()
+    except (imaplib.IMAP4.error, OSError):
+        pass
 
 
 def print_cospend_project_infos():
-    config = _init()
+    config = init()
     project_infos = get_cospend_project_infos(config)
     click.echo("Categories  (Used for  COSPEND_CATEGORYID_... )")
     click.echo("----------")
@@ -0,0 +1,232 @@
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# Counters, gauges and histograms in the Prometheus text format, served on /metrics if METRICS_PORT is set.
+# While metrics are disabled every metric hands out the same no-op child, so instrumented code only pays
+# for one function call.
+
+_enabled = False
+_registry: List['_Metric'] = []
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class _Timer:
+
+    def __init__(self, child):
+        self._child = child
+        self._start = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._child.observe(time.perf_counter() - self._start)
+
+
+class _NoopChild:
+
+    def inc(self, amount: float = 1):
+        pass
+
+    def set(self, value: float):
+        pass
+
+    def observe(self, value: float):
+        pass
+
+    def time(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NOOP = _NoopChild()
+
+
+class _ValueChild:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class _HistogramChild:
+
+    def __init__(self, buckets: Sequence[float]):
+        self._lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        with self._lock:
+            self.sum += value
+            self.count += 1
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+
+    def time(self) -> _Timer:
+        return _Timer(self)
+
+
+class _Metric:
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = "mail2cospend_" + name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = dict()
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _new_child(self):
+        return _ValueChild()
+
+    def labels(self, **labels):
+        if not _enabled:
+            return _NOOP
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _format_labels(self, key: Tuple[str, ...], extra: Optional[Tuple[str, str]] = None) -> str:
+        pairs = list(zip(self.labelnames, key))
+        if extra is not None:
+            pairs.append(extra)
+        if len(pairs) == 0:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+    def collect(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for key, child in list(self._children.items()):
+            lines.append(f"{self.name}{self._format_labels(key)} {child.value}")
+        return lines
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def collect(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for key, child in list(self._children.items()):
+            cumulative = 0
+            for bound, count in zip(child.buckets, child.counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{self._format_labels(key, ('le', str(bound)))} {cumulative}")
+            lines.append(f"{self.name}_bucket{self._format_labels(key, ('le', '+Inf'))} {child.count}")
+            lines.append(f"{self.name}_sum{self._format_labels(key)} {child.sum}")
+            lines.append(f"{self.name}_count{self._format_labels(key)} {child.count}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def generate_latest() -> bytes:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.collect())
+    return ("\n".join(lines) + "\n").encode('utf-8')
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = generate_latest()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def enable(port: Optional[int], host: str = '0.0.0.0') -> Optional[ThreadingHTTPServer]:
+    # Starts collecting and serves the metrics on http://host:port/metrics, does nothing without a port
+    global _enabled
+    if not port or _enabled:
+        return None
+    _enabled = True
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Serving metrics on http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+IMAP_CONNECT_SECONDS = Histogram('imap_connect_seconds', "Time to connect and log in to the imap server")
+SEARCH_SECONDS = Histogram('imap_search_seconds', "Time of the combined imap search of all adapters")
+FETCH_SECONDS = Histogram('imap_fetch_seconds', "Time of an imap fetch command", ['items'])
+FETCHED_BYTES = Counter('imap_fetched_bytes_total', "Bytes of mail content fetched from the imap server")
+PARSE_SECONDS = Histogram('parse_seconds', "Time to parse a mail", ['adapter'])
+PARSE_CACHE_HITS = Counter('parse_cache_hits_total', "Mails whose parse result was taken from the cache", ['adapter'])
+BONS_FOUND = Counter('bons_found_total', "Unpublished bons found in the mails", ['adapter'])
+PDF_PAGES = Counter('pdf_pages_extracted_total', "PDF pages whose text was extracted")
+PUBLISH_SECONDS = Histogram('publish_seconds', "Time to publish a bill to cospend")
+PUBLISH_RESPONSES = Counter('publish_responses_total', "Responses of cospend to published bills", ['status'])
+PUBLISH_RETRIES = Counter('publish_retries_total', "Bills scheduled for another publish attempt")
+PUBLISH_FAILURES = Counter('publish_failures_total', "Bills given up on")
+PUBLISHED_IDS = Gauge('published_ids', "Number of ids in the published id store")
+CYCLE_SECONDS = Histogram('cycle_seconds', "Time of a full search and publish cycle")
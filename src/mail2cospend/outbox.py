@@ -0,0 +1,138 @@
+import enum
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import List, Optional
+
+from mail2cospend import metrics
+from mail2cospend.config import Config
+from mail2cospend.data import BonSummary
+
+
+class OutboxState(str, enum.Enum):
+    PENDING = "pending"
+    IN_FLIGHT = "in_flight"
+    DONE = "done"
+    FAILED = "failed"
+
+
+# Durable queue of the bons which have to be published to cospend. Every bon is retried on its own with a
+# jittered exponential backoff (capped at `max_delay` seconds) until it is published or `max_attempts` is reached.
+class Outbox:
+
+    def __init__(self, path: str = os.path.join("data", "outbox.db"), base_delay: float = 60,
+                 max_delay: float = 3600, max_attempts: int = 20):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.mkdir(directory)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id TEXT PRIMARY KEY,
+                bon TEXT NOT NULL,
+                email_date TEXT NOT NULL,
+                state TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                last_error TEXT
+            )""")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (state, next_attempt_at)")
+        # Bons which were in flight when the process stopped have an unknown result, try them again
+        cursor = self._connection.execute("UPDATE outbox SET state = ? WHERE state = ?",
+                                          (OutboxState.PENDING.value, OutboxState.IN_FLIGHT.value))
+        if cursor.rowcount > 0:
+            logging.warning(f"Requeued {cursor.rowcount} bons which were in flight when the last run stopped")
+        self._connection.commit()
+
+    @classmethod
+    def from_config(cls, config: Config) -> 'Outbox':
+        return cls(base_delay=config.interval, max_delay=config.publish_max_backoff,
+                   max_attempts=config.publish_max_attempts)
+
+    def __contains__(self, bon_id: str) -> bool:
+        with self._lock:
+            row = self._connection.execute("SELECT 1 FROM outbox WHERE id = ?", (bon_id,)).fetchone()
+        return row is not None
+
+    def enqueue(self, bons: List[BonSummary]):
+        # Known bons keep their state, so failed bons are not retried just because they are found again
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO outbox (id, bon, email_date, state, next_attempt_at) VALUES (?, ?, ?, ?, ?)",
+                [(bon.get_id(), json.dumps(bon.as_dict()), bon.timestamp.isoformat(), OutboxState.PENDING.value,
+                  time.time()) for bon in bons])
+            self._connection.commit()
+
+    def take_due(self) -> List[BonSummary]:
+        # Returns the pending bons whose next attempt is due and marks them as in flight
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT id, bon FROM outbox WHERE state = ? AND next_attempt_at <= ? ORDER BY email_date",
+                (OutboxState.PENDING.value, time.time())).fetchall()
+            self._connection.executemany("UPDATE outbox SET state = ? WHERE id = ?",
+                                         [(OutboxState.IN_FLIGHT.value, row[0]) for row in rows])
+            self._connection.commit()
+        return [BonSummary.from_dict(json.loads(row[1])) for row in rows]
+
+    def done(self, bon: BonSummary):
+        self._set_state(bon, OutboxState.DONE, None)
+
+    def requeue(self, bon: BonSummary):
+        # Puts an in flight bon back without counting an attempt
+        self._set_state(bon, OutboxState.PENDING, None)
+
+    def fail(self, bon: BonSummary, error: str):
+        logging.error(f"Bon {bon} can not be published and is not retried: {error}")
+        metrics.PUBLISH_FAILURES.inc()
+        self._set_state(bon, OutboxState.FAILED, error)
+
+    def retry(self, bon: BonSummary, error: str):
+        with self._lock:
+            attempts = self._connection.execute("SELECT attempts FROM outbox WHERE id = ?",
+                                                (bon.get_id(),)).fetchone()[0] + 1
+        if attempts >= self.max_attempts:
+            self.fail(bon, f"{error} (gave up after {attempts} attempts)")
+            return
+        metrics.PUBLISH_RETRIES.inc()
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        # Jitter the delay, so bons which failed together are not retried in lockstep
+        delay = random.uniform(delay / 2, delay)
+        logging.warning(f"Bon {bon} was not published ({error}), retrying in {int(delay)} seconds")
+        with self._lock:
+            self._connection.execute(
+                "UPDATE outbox SET state = ?, attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                (OutboxState.PENDING.value, attempts, time.time() + delay, error, bon.get_id()))
+            self._connection.commit()
+
+    def _set_state(self, bon: BonSummary, state: OutboxState, error: Optional[str]):
+        with self._lock:
+            self._connection.execute("UPDATE outbox SET state = ?, last_error = ? WHERE id = ?",
+                                     (state.value, error, bon.get_id()))
+            self._connection.commit()
+
+    def seconds_until_next_attempt(self) -> Optional[float]:
+        with self._lock:
+            row = self._connection.execute("SELECT MIN(next_attempt_at) FROM outbox WHERE state = ?",
+                                           (OutboxState.PENDING.value,)).fetchone()
+        if row[0] is None:
+            return None
+        return max(0.0, row[0] - time.time())
+
+    def evict_done_before(self, since: datetime):
+        # Published bons older than the SINCE window are never found again
+        with self._lock:
+            cursor = self._connection.execute("DELETE FROM outbox WHERE state = ? AND email_date < ?",
+                                              (OutboxState.DONE.value, since.replace(tzinfo=None).isoformat()))
+            self._connection.commit()
+        if cursor.rowcount > 0:
+            logging.debug(f"Evicted {cursor.rowcount} published bons from the outbox")
@@ -0,0 +1,70 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Iterable, Optional, Tuple
+
+from mail2cospend.data import BonSummary
+
+
+def get_cache_key(message_id: Optional[str], contents: Iterable[bytes] = ()) -> str:
+    if message_id:
+        return "message-id:" + message_id.strip()
+    content_hash = hashlib.sha256()
+    for content in contents:
+        content_hash.update(content)
+    return "sha256:" + content_hash.hexdigest()
+
+
+# Remembers the parse result of each mail (the bon or that it is not a bon) per adapter, so mails which show up
+# again in a later cycle are neither downloaded nor parsed again.
+class ParseCache:
+
+    def __init__(self, path: str = os.path.join("data", "parse_cache.db")):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.mkdir(directory)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS parse_cache (
+                key TEXT NOT NULL,
+                adapter TEXT NOT NULL,
+                email_date TEXT NOT NULL,
+                bon TEXT,
+                PRIMARY KEY (key, adapter)
+            )""")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS parse_cache_email_date ON parse_cache (email_date)")
+        self._connection.commit()
+
+    def get(self, key: str, adapter: str) -> Tuple[bool, Optional[BonSummary]]:
+        # Returns (False, None) if the mail is unknown, (True, None) if it is known not to contain a bon
+        with self._lock:
+            row = self._connection.execute("SELECT bon FROM parse_cache WHERE key = ? AND adapter = ?",
+                                           (key, adapter)).fetchone()
+        if row is None:
+            return False, None
+        if row[0] is None:
+            return True, None
+        return True, BonSummary.from_dict(json.loads(row[0]))
+
+    def put(self, key: str, adapter: str, email_timestamp: datetime, bon: Optional[BonSummary]):
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO parse_cache (key, adapter, email_date, bon) VALUES (?, ?, ?, ?)",
+                (key, adapter, email_timestamp.isoformat(), json.dumps(bon.as_dict()) if bon is not None else None))
+
+    def evict_before(self, since: datetime):
+        # Mails older than the SINCE window are never requested again
+        with self._lock:
+            cursor = self._connection.execute("DELETE FROM parse_cache WHERE email_date < ?",
+                                              (since.replace(tzinfo=None).isoformat(),))
+        if cursor.rowcount > 0:
+            logging.debug(f"Evicted {cursor.rowcount} entries from the parse cache")
+
+    def commit(self):
+        with self._lock:
+            self._connection.commit()
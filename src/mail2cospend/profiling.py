@@ -0,0 +1,77 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Iterator
+
+
+# Profiles whole cycles on request with cProfile and tracemalloc. For each profiled cycle a .prof file (for
+# snakeviz, pstats, ..) and a .txt summary with the slowest functions and the top allocations are written.
+# cProfile only sees the thread which runs the cycle, so set IMAP_CONNECTIONS=1 and PARSE_PROCESSES=0 to
+# profile the parsing as well.
+class CycleProfiler:
+
+    def __init__(self, directory: str = os.path.join("data", "profiles"), top: int = 30):
+        self.directory = directory
+        self.top = top
+        self._lock = threading.Lock()
+        self._requested = 0
+        # Only one cycle is profiled at a time, cProfile and tracemalloc are process-wide (several accounts)
+        self._active = False
+
+    def request(self, cycles: int = 1):
+        # Only stores the request, so it can be called from a signal handler
+        self._requested += cycles
+
+    @contextmanager
+    def cycle(self) -> Iterator[None]:
+        with self._lock:
+            if self._requested <= 0 or self._active:
+                active = False
+            else:
+                self._requested -= 1
+                self._active = True
+                active = True
+        if not active:
+            yield
+            return
+        logging.info("Profiling this cycle")
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            if not tracing:
+                tracemalloc.stop()
+            with self._lock:
+                self._active = False
+            self._write(profile, snapshot, peak)
+
+    def _write(self, profile: cProfile.Profile, snapshot: tracemalloc.Snapshot, peak: int):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, datetime.now().strftime("cycle-%Y%m%d-%H%M%S-%f"))
+        profile.dump_stats(path + ".prof")
+        summary = io.StringIO()
+        pstats.Stats(profile, stream=summary).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.top)
+        summary.write(f"Peak traced memory: {peak / 1024:.1f} KiB\n")
+        summary.write(f"Top {self.top} allocations (by line):\n")
+        for statistic in snapshot.statistics('lineno')[:self.top]:
+            summary.write(f"  {statistic}\n")
+        with open(path + ".txt", 'w') as f:
+            f.write(summary.getvalue())
+        logging.info(f"Wrote the profile of this cycle to {path}.prof and {path}.txt")
+
+
+profiler = CycleProfiler()
@@ -0,0 +1,79 @@
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from typing import List, Set
+
+from mail2cospend import metrics
+from mail2cospend.config import Config
+from mail2cospend.data import BonSummary
+
+
+# Stores the ids of the published bons in an indexed SQLite table. All ids are kept in memory as well,
+# so membership checks never hit the disk. New ids are written in batches of `flush_size`.
+class PublishedIdStore:
+
+    def __init__(self, path: str = os.path.join("data", "published_ids.db"), synchronous: str = "NORMAL",
+                 flush_size: int = 1):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.mkdir(directory)
+        self.flush_size = flush_size
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        # WAL keeps committed ids safe if the process crashes, "synchronous" controls the fsync behaviour
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(f"PRAGMA synchronous={synchronous}")
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS published_ids (
+                id TEXT PRIMARY KEY,
+                published_at TEXT NOT NULL
+            )""")
+        self._connection.commit()
+        self._migrate_text_file(os.path.join(directory, "published_ids.txt"))
+        self._ids: Set[str] = {row[0] for row in self._connection.execute("SELECT id FROM published_ids")}
+        self._pending: List[tuple] = []
+        metrics.PUBLISHED_IDS.set(len(self._ids))
+
+    @classmethod
+    def from_config(cls, config: Config) -> 'PublishedIdStore':
+        return cls(synchronous=config.published_ids_synchronous, flush_size=config.published_ids_flush_size)
+
+    def _migrate_text_file(self, path: str):
+        if not os.path.exists(path):
+            return
+        with open(path, 'r') as f:
+            ids = {line.strip() for line in f if line.strip()}
+        published_at = datetime.now().isoformat()
+        self._connection.executemany("INSERT OR IGNORE INTO published_ids (id, published_at) VALUES (?, ?)",
+                                     [(bon_id, published_at) for bon_id in ids])
+        self._connection.commit()
+        os.replace(path, path + ".migrated")
+        logging.info(f"Migrated {len(ids)} published ids from {path}")
+
+    def __contains__(self, bon_id: str) -> bool:
+        return bon_id in self._ids
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def add(self, bon_summary: BonSummary):
+        with self._lock:
+            self._ids.add(bon_summary.get_id())
+            metrics.PUBLISHED_IDS.set(len(self._ids))
+            self._pending.append((bon_summary.get_id(), datetime.now().isoformat()))
+            if len(self._pending) >= self.flush_size:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if len(self._pending) == 0:
+            return
+        self._connection.executemany("INSERT OR IGNORE INTO published_ids (id, published_at) VALUES (?, ?)",
+                                     self._pending)
+        self._connection.commit()
+        self._pending.clear()
@@ -1,11 +1,19 @@
-from .netto import NettoSearchAdapter
-from .picnic import PicnicSearchAdapter
-from .planted import PlantedSearchAdapter
-from .rewe import ReweSearchAdapter
-from .edeka import EdekaSearchAdapter
-from .ikea import IkeaSearchAdapter
+import importlib
+
+from .registry import BUILTIN_ADAPTERS, ENTRY_POINT_GROUP, get_adapter_names, load_adapter_class
+from .rules import ReceiptRules, Rule
 from .searchadapter import SearchAdapter
 
-all_search_adapters = SearchAdapter.__subclasses__()
+_builtin_classes = {path.partition(':')[2]: path.partition(':')[0] for path in BUILTIN_ADAPTERS.values()}
+
+__all__ = list(_builtin_classes) + ['SearchAdapter', 'ENTRY_POINT_GROUP', 'get_adapter_names', 'load_adapter_class',
+                                    'all_search_adapters', 'ReceiptRules', 'Rule']
+
 
-__all__ = [cls.__name__ for cls in all_search_adapters] + ['SearchAdapter']
+def __getattr__(name: str):
+    # The adapters are only imported when they are requested
+    if name == 'all_search_adapters':
+        return [load_adapter_class(adapter_name) for adapter_name in get_adapter_names()]
+    if name in _builtin_classes:
+        return getattr(importlib.import_module(_builtin_classes[name]), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,13 +1,18 @@
 from datetime import datetime
 from typing import Iterable, Optional
 
-from PyPDF2 import PdfReader
-
 from mail2cospend.data import BonSummary
+from mail2cospend.searchadapter.pdfdocument import PdfDocument
+from mail2cospend.searchadapter.rules import AMOUNT, DATE, ReceiptRules, Rule, parse_amount, parse_date
 from mail2cospend.searchadapter.searchadapter import SearchAdapter
 
 
 class IkeaSearchAdapter(SearchAdapter):
+    _rules = ReceiptRules(
+        Rule(rf'Gesamtsumme:.*?(?P<sum>{AMOUNT})$', marker='Gesamtsumme:', sum=parse_amount),
+        Rule(r'Rechnungsnummer:.*?(?P<document>[^ ]+)$', marker='Rechnungsnummer:'),
+        Rule(rf'Rechnungsdatum:.*?(?P<date>{DATE})', marker='Rechnungsdatum:', date=parse_date),
+    )
 
     @classmethod
     def adapter_name(cls) -> str:
@@ -33,24 +38,11 @@ class IkeaSearchAdapter(SearchAdapter):
     def _coding(self) -> str:
         return 'utf-8'
 
-    def _get_bon_from_pdf(self, pdf: PdfReader, email_timestamp: datetime) -> Optional[BonSummary]:
-        data = [l.strip()
-                for page in pdf.pages
-                for l in page.extract_text().split("\n")]
-        sum = [float(l.replace(",", ".").split()[-1])
-               for l in data
-               if "Gesamtsumme:" in l][0]
-        beleg = [l.strip().split(" ")[-1]
-                 for l in data
-                 if "Rechnungsnummer:" in l][0]
-        date = [l.strip().split(" ")[-1]
-                for l in data
-                if "Rechnungsdatum:" in l][0]
-        day, month, year = map(int, date.split("."))
-
-        timestamp = datetime(year=year, month=month, day=day)
-
-        bon = BonSummary(sum=sum, document=beleg, timestamp=timestamp, adapter_name=self.adapter_name())
+    def _get_bon_from_pdf(self, pdf: PdfDocument, email_timestamp: datetime) -> Optional[BonSummary]:
+        fields = self._rules.extract(pdf.iter_lines())
+        timestamp = datetime.combine(fields["date"], datetime.min.time())
+        bon = BonSummary(sum=fields["sum"], document=fields["document"], timestamp=timestamp,
+                         adapter_name=self.adapter_name())
         return bon
 
     def _get_bon_from_text(self, payload: Iterable[str], email_timestamp: datetime, is_html: bool) -> Optional[
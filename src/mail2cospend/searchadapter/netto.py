@@ -1,13 +1,16 @@
 from datetime import datetime
 from typing import Iterable, Optional
 
-from PyPDF2 import PdfReader
-
 from mail2cospend.data import BonSummary
+from mail2cospend.searchadapter.pdfdocument import PdfDocument
+from mail2cospend.searchadapter.rules import AMOUNT, ReceiptRules, Rule, parse_amount
 from mail2cospend.searchadapter.searchadapter import SearchAdapter
 
 
 class NettoSearchAdapter(SearchAdapter):
+    _rules = ReceiptRules(
+        Rule(rf'SUMME\s*(?P<sum>{AMOUNT})', marker='SUMME', sum=parse_amount),
+    )
 
     @classmethod
     def adapter_name(cls) -> str:
@@ -29,15 +32,12 @@ class NettoSearchAdapter(SearchAdapter):
     def _search_query(self) -> str:
         return f'(FROM nicht.antworten@reply.netto-online.de) (SUBJECT "Marken-Discount!") (SINCE "{self.config.get_since_for_imap_query()}")'
 
-    def _get_bon_from_pdf(self, pdf: PdfReader, email_timestamp: datetime) -> Optional[BonSummary]:
+    def _get_bon_from_pdf(self, pdf: PdfDocument, email_timestamp: datetime) -> Optional[BonSummary]:
         return None
 
     def _get_bon_from_text(self, payload: Iterable[str], email_timestamp: datetime, is_html: bool) -> Optional[
         BonSummary]:
-        sum = 0
-        for row in payload:
-            if "SUMME" in row:
-                sum = float(row.replace("SUMME","").replace(",",".").strip())
-                break
-        bon = BonSummary(sum=sum, document="", timestamp=email_timestamp, adapter_name=self.adapter_name())
+        fields = self._rules.extract(payload)
+        bon = BonSummary(sum=fields.get("sum", 0), document="", timestamp=email_timestamp,
+                         adapter_name=self.adapter_name())
         return bon
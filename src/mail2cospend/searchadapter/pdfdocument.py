@@ -0,0 +1,22 @@
+from typing import TYPE_CHECKING, Iterator, List
+
+if TYPE_CHECKING:
+    from PyPDF2 import PdfReader
+
+from mail2cospend import metrics
+
+
+# Wraps a PDF attachment and extracts the text of each page at most once. Pages are only extracted when a
+# parser reaches them, so a parser which finds all fields on the first page never touches the others.
+class PdfDocument:
+
+    def __init__(self, reader: 'PdfReader'):
+        self.reader = reader
+        self._page_lines: List[List[str]] = []
+
+    def iter_lines(self) -> Iterator[str]:
+        for index, page in enumerate(self.reader.pages):
+            if index == len(self._page_lines):
+                self._page_lines.append([line.strip() for line in page.extract_text().split("\n")])
+                metrics.PDF_PAGES.inc()
+            yield from self._page_lines[index]
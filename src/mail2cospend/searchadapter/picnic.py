@@ -1,13 +1,17 @@
 from datetime import datetime
 from typing import Iterable, Optional
 
-from PyPDF2 import PdfReader
-
 from mail2cospend.data import BonSummary
+from mail2cospend.searchadapter.pdfdocument import PdfDocument
+from mail2cospend.searchadapter.rules import AMOUNT, ReceiptRules, Rule, parse_amount
 from mail2cospend.searchadapter.searchadapter import SearchAdapter
 
 
 class PicnicSearchAdapter(SearchAdapter):
+    _rules = ReceiptRules(
+        # The last "Gesamtbetrag" is the amount which is charged
+        Rule(rf'Gesamtbetrag\s+(?P<sum>{AMOUNT})', marker='Gesamtbetrag', last=True, sum=parse_amount),
+    )
 
     @classmethod
     def adapter_name(cls) -> str:
@@ -29,18 +33,16 @@ class PicnicSearchAdapter(SearchAdapter):
     def _search_query(self) -> str:
         return f'(FROM info@mail.picnic.de) (SUBJECT "Dein Bon") (SINCE "{self.config.get_since_for_imap_query()}")'
 
+    @property
     def _coding(self) -> str:
         return 'latin-1'
 
-    def _get_bon_from_pdf(self, pdf: PdfReader, email_timestamp: datetime) -> Optional[BonSummary]:
+    def _get_bon_from_pdf(self, pdf: PdfDocument, email_timestamp: datetime) -> Optional[BonSummary]:
         return None
 
     def _get_bon_from_text(self, payload: Iterable[str], email_timestamp: datetime, is_html: bool) -> Optional[
         BonSummary]:
-        sum = 0
-        # beleg = payload[1] + " " + payload[5]
-        for row in payload:
-            if "Gesamtbetrag" in row:
-                sum = float(row.split()[1].replace("..", "."))
-        bon = BonSummary(sum=sum, document="", timestamp=email_timestamp, adapter_name=self.adapter_name())
+        fields = self._rules.extract(payload)
+        bon = BonSummary(sum=fields.get("sum", 0), document="", timestamp=email_timestamp,
+                         adapter_name=self.adapter_name())
         return bon
@@ -1,13 +1,17 @@
 from datetime import datetime
 from typing import Iterable, Optional
 
-from PyPDF2 import PdfReader
-
 from mail2cospend.data import BonSummary
+from mail2cospend.searchadapter.pdfdocument import PdfDocument
+from mail2cospend.searchadapter.rules import AMOUNT, ReceiptRules, Rule, parse_amount
 from mail2cospend.searchadapter.searchadapter import SearchAdapter
 
 
 class PlantedSearchAdapter(SearchAdapter):
+    # The sum is the first value on the lines after "Total"
+    _rules = ReceiptRules(
+        Rule(rf'^\s*(?P<sum>{AMOUNT})', after='Total', sum=parse_amount),
+    )
 
     @classmethod
     def adapter_name(cls) -> str:
@@ -29,20 +33,12 @@ class PlantedSearchAdapter(SearchAdapter):
     def _search_query(self) -> str:
         return f'(FROM shop@eatplanted.com) (SUBJECT "Bestellung") (SINCE "{self.config.get_since_for_imap_query()}")'
 
-    def _get_bon_from_pdf(self, pdf: PdfReader, email_timestamp: datetime) -> Optional[BonSummary]:
+    def _get_bon_from_pdf(self, pdf: PdfDocument, email_timestamp: datetime) -> Optional[BonSummary]:
         return None
 
     def _get_bon_from_text(self, payload: Iterable[str], email_timestamp: datetime, is_html: bool) -> Optional[
         BonSummary]:
-        found_total = False
-        sum = 0
-        for row in payload:
-            row = row.strip()
-            if "Total" in row:
-                found_total = True
-                continue
-            elif found_total and len(row) > 0:
-                sum = float(row.split()[0].replace(",", "."))
-                break
-        bon = BonSummary(sum=sum, document="", timestamp=email_timestamp, adapter_name=self.adapter_name())
+        fields = self._rules.extract(payload)
+        bon = BonSummary(sum=fields.get("sum", 0), document="", timestamp=email_timestamp,
+                         adapter_name=self.adapter_name())
         return bon
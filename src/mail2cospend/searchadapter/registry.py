@@ -0,0 +1,54 @@
+import functools
+import importlib
+import logging
+from importlib.metadata import entry_points
+from typing import Dict, List, Type
+
+from mail2cospend.searchadapter.searchadapter import SearchAdapter
+
+# Adapters are registered by name and only imported when they are used. Additional adapters can be shipped in
+# their own package by registering the adapter class as an entry point of the 'mail2cospend.adapters' group
+# under its adapter name, e.g. in the pyproject.toml of the package:
+#
+#   [project.entry-points."mail2cospend.adapters"]
+#   Aldi = "mail2cospend_aldi:AldiSearchAdapter"
+
+ENTRY_POINT_GROUP = 'mail2cospend.adapters'
+
+BUILTIN_ADAPTERS = {
+    "Netto": "mail2cospend.searchadapter.netto:NettoSearchAdapter",
+    "Picnic": "mail2cospend.searchadapter.picnic:PicnicSearchAdapter",
+    "Planted": "mail2cospend.searchadapter.planted:PlantedSearchAdapter",
+    "Rewe": "mail2cospend.searchadapter.rewe:ReweSearchAdapter",
+    "EDEKA": "mail2cospend.searchadapter.edeka:EdekaSearchAdapter",
+    "IKEA": "mail2cospend.searchadapter.ikea:IkeaSearchAdapter",
+}
+
+
+@functools.cache
+def _registered_adapters() -> Dict[str, str]:
+    # Adapter name -> "module:class", entry points may not replace a builtin adapter
+    adapters = dict(BUILTIN_ADAPTERS)
+    for entry_point in entry_points(group=ENTRY_POINT_GROUP):
+        if entry_point.name in adapters:
+            logging.warning(f"Ignoring the adapter entry point '{entry_point.value}', "
+                            f"the adapter name '{entry_point.name}' is already registered")
+            continue
+        adapters[entry_point.name] = entry_point.value
+    return adapters
+
+
+def get_adapter_names() -> List[str]:
+    return list(_registered_adapters().keys())
+
+
+@functools.cache
+def load_adapter_class(name: str) -> Type[SearchAdapter]:
+    module_name, _, class_name = _registered_adapters()[name].partition(':')
+    adapter_cls = getattr(importlib.import_module(module_name), class_name)
+    if not issubclass(adapter_cls, SearchAdapter):
+        raise TypeError(f"The adapter '{name}' ({adapter_cls.__name__}) is no SearchAdapter")
+    if adapter_cls.adapter_name() != name:
+        raise TypeError(f"The adapter '{name}' is registered under a different name than "
+                        f"its adapter name '{adapter_cls.adapter_name()}'")
+    return adapter_cls
@@ -1,13 +1,20 @@
 import datetime
 from typing import Iterable, Optional
 
-from PyPDF2 import PdfReader
-
 from mail2cospend.data import BonSummary
+from mail2cospend.searchadapter.pdfdocument import PdfDocument
+from mail2cospend.searchadapter.rules import AMOUNT, DATE, TIME, ReceiptRules, Rule, parse_amount, parse_date, \
+    parse_time
 from mail2cospend.searchadapter.searchadapter import SearchAdapter
 
 
 class ReweSearchAdapter(SearchAdapter):
+    # "SUMME EUR 12,34" and "03.02.2024     12:34     Bon-Nr.:1234"
+    _rules = ReceiptRules(
+        Rule(rf'SUMME\s*(?:EUR\s*)?(?P<sum>{AMOUNT})', marker='SUMME', sum=parse_amount),
+        Rule(rf'(?P<date>{DATE}) {{5}}(?P<time>{TIME}) {{5}}(?P<document>.*?Bon-Nr\..*?)(?: {{5}}|$)',
+             marker='Bon-Nr.', date=parse_date, time=parse_time),
+    )
 
     @classmethod
     def adapter_name(cls) -> str:
@@ -29,21 +36,11 @@ class ReweSearchAdapter(SearchAdapter):
     def _search_query(self) -> str:
         return f'(FROM ebon@mailing.rewe.de) (SUBJECT "REWE eBon") (SINCE "{self.config.get_since_for_imap_query()}")'
 
-    def _get_bon_from_pdf(self, pdf: PdfReader, email_timestamp: datetime.datetime) -> Optional[BonSummary]:
-        sum = [float(l.replace(",", ".").replace("SUMME", "").replace("EUR", "").strip())
-               for page in pdf.pages
-               for l in page.extract_text().split("\n")
-               if "SUMME" in l][0]
-        datarow = [l.strip().split("     ")
-                   for page in pdf.pages
-                   for l in page.extract_text().split("\n")
-                   if "Bon-Nr." in l][0]
-        day, month, year = map(int, datarow[0].split("."))
-        hour, minute = map(int, datarow[1].split(":"))
-        beleg = datarow[2]
-        timestamp = datetime.datetime(year=year, month=month, day=day, hour=hour, minute=minute)
-
-        bon = BonSummary(sum=sum, document=beleg, timestamp=timestamp, adapter_name=self.adapter_name())
+    def _get_bon_from_pdf(self, pdf: PdfDocument, email_timestamp: datetime.datetime) -> Optional[BonSummary]:
+        fields = self._rules.extract(pdf.iter_lines())
+        timestamp = datetime.datetime.combine(fields["date"], fields["time"])
+        bon = BonSummary(sum=fields["sum"], document=fields["document"], timestamp=timestamp,
+                         adapter_name=self.adapter_name())
         return bon
 
     def _get_bon_from_text(self, payload: Iterable[str], email_timestamp: datetime, is_html: bool) -> Optional[
@@ -0,0 +1,88 @@
+import re
+from datetime import date, datetime, time
+from typing import Callable, Dict, Iterable, Optional
+
+# Declarative extraction of the fields of a receipt. An adapter declares a Rule per line it is interested in, the
+# named groups of the rule's pattern are the fields it yields. The patterns are compiled once when the adapter class
+# is defined, and all rules of an adapter are applied in a single pass over the lines, which ends as soon as every
+# rule has matched.
+
+# Amounts like "12,34", "1.234,56", "12.34" or "12..34"
+AMOUNT = r'-?\d+(?:[.,]+\d+)*'
+DATE = r'\d{1,2}\.\d{1,2}\.\d{4}'
+TIME = r'\d{1,2}:\d{2}(?::\d{2})?'
+
+
+def parse_amount(value: str) -> float:
+    value = re.sub(r'([.,])\1+', r'\1', value)
+    if ',' in value:
+        value = value.replace('.', '').replace(',', '.')
+    return float(value)
+
+
+def parse_date(value: str) -> date:
+    return datetime.strptime(value, '%d.%m.%Y').date()
+
+
+def parse_time(value: str) -> time:
+    return datetime.strptime(value, '%H:%M:%S' if value.count(':') == 2 else '%H:%M').time()
+
+
+class Rule:
+
+    def __init__(self, pattern: str, marker: Optional[str] = None, after: Optional[str] = None, last: bool = False,
+                 **converters: Callable[[str], object]):
+        # `marker` is a text every matching line contains, lines without it are skipped before running the pattern.
+        # `after` makes the rule only look at the lines following the first line which contains it.
+        # `last` takes the fields of the last matching line instead of the first, which reads all lines.
+        self.regex = re.compile(pattern)
+        self.marker = marker
+        self.after = after
+        self.last = last
+        self.converters = converters
+        unknown = set(converters) - set(self.regex.groupindex)
+        if len(unknown) > 0:
+            raise ValueError(f"The pattern '{pattern}' has no group for {', '.join(sorted(unknown))}")
+
+    def convert(self, match: re.Match) -> Dict[str, object]:
+        return {name: self.converters.get(name, str)(value) for name, value in match.groupdict().items()}
+
+
+class ReceiptRules:
+
+    def __init__(self, *rules: Rule):
+        self.rules = rules
+
+    def extract(self, lines: Iterable[str]) -> Dict[str, object]:
+        # The fields of the first (or last) line matched by each rule, fields of rules which never matched are missing
+        fields = dict()
+        lines = iter(lines)
+        pending = [[rule.after, rule.marker or '', rule] for rule in self.rules]
+        while len(pending) > 0:
+            if len(pending) == 1 and pending[0][0] is None:
+                # Only one field is left (e.g. the sum of a text mail), look for it in the tightest loop
+                _, marker, rule = pending[0]
+                for line in lines:
+                    if marker in line and (match := rule.regex.search(line)) is not None:
+                        fields.update(rule.convert(match))
+                        if not rule.last:
+                            break
+                return fields
+            matched = False
+            for line in lines:
+                for entry in pending:
+                    after, marker, rule = entry
+                    if after is not None:
+                        if after in line:
+                            entry[0] = None
+                    elif marker in line and (match := rule.regex.search(line)) is not None:
+                        fields.update(rule.convert(match))
+                        if not rule.last:
+                            entry[2] = None
+                            matched = True
+                if matched:
+                    break
+            if not matched:
+                return fields
+            pending = [entry for entry in pending if entry[2] is not None]
+        return fields
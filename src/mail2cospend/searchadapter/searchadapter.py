@@ -1,23 +1,43 @@
-import email
-import imaplib
+import dataclasses
+import functools
+import io
 import logging
 import os
+import tempfile
 from abc import ABC, abstractmethod
+from concurrent.futures import Executor
+from contextlib import contextmanager
 from datetime import datetime
-from email import utils
-from typing import List, Optional, Iterable
-
-from PyPDF2 import PdfReader
+from email.message import Message
+from email.parser import BytesParser
+from typing import BinaryIO, Callable, Dict, List, Optional, Iterable, Iterator, Union
 
 from mail2cospend.data import BonSummary
-from mail2cospend.helper import get_published_ids
+from mail2cospend import imapparser
+from mail2cospend.searchadapter.pdfdocument import PdfDocument
+
+
+_message_parser = BytesParser()
+
+_PDF_CONTENT_TYPES = ('application/octet-stream', 'application/pdf')
+
+# The search keys which are checked against the headers of a mail to find the adapters it belongs to
+_ROUTING_KEYS = ('FROM', 'SUBJECT')
+
+
+# A part of a mail, its payload is only loaded and decoded when an adapter tries it
+@dataclasses.dataclass(frozen=True)
+class MailPart:
+    content_type: str
+    filename: Optional[str]
+    charset: Optional[str]
+    load: Callable[[], Optional[bytes]]
 
 
 class SearchAdapter(ABC):
 
-    def __init__(self, config, imap: imaplib.IMAP4_SSL):
+    def __init__(self, config):
         self.config = config
-        self.imap = imap
 
     @classmethod
     def adapter_name(cls) -> str:
@@ -40,78 +60,155 @@ class SearchAdapter(ABC):
     def _search_query(self) -> str:
         pass
 
+    @property
+    def _mailbox(self) -> Optional[str]:
+        # A dedicated folder the mails of the adapter are sorted into, instead of the inbox
+        return None
+
+    def get_mailbox(self) -> str:
+        return self.config.get_imap_folder(self.adapter_name()) or self._mailbox or self.config.imap_inbox
+
     @property
     def _coding(self) -> str:
+        # Used for text parts which do not declare a (known) charset
         return 'utf-8'
 
-    def search(self) -> List[BonSummary]:
-        published_ids = get_published_ids()
-        search_query = self._search_query
-        logging.info(f"Requesting {self.adapter_name()} from the mail server")
-        logging.debug(f" search for: {search_query}")
-        self.imap.select(self.config.imap_inbox)
-        tmp, data = self.imap.search(None, search_query)
-        result = []
-        for num in data[0].split():
-            typ, data = self.imap.fetch(num, '(RFC822)')
-            raw_email = data[0][1]
-            raw = email.message_from_bytes(data[0][1])
-            email_timestamp = utils.parsedate_to_datetime(raw['date']).replace(tzinfo=None)
-            raw_email_string = raw_email.decode('utf-8')
-            msg = email.message_from_string(raw_email_string)
-            # look for the mail part
-            bon = None
-            for part in msg.walk():
-                if self._use_html_text_in_mail() and part.get_content_type() == 'text/html':
-                    payload = part.get_payload(decode=True).decode(self._coding).split("\r\n")
-                    bon = self._get_bon_from_text(payload, email_timestamp, is_html=True)
-                    if bon is None:
-                        logging.warning("Bon can not be parsed")
-                if self._use_plain_text_in_mail() and part.get_content_type() == 'text/plain':
-                    payload = part.get_payload(decode=True).decode(self._coding).split("\r\n")
-                    bon = self._get_bon_from_text(payload, email_timestamp, is_html=False)
-                    if bon is None:
-                        logging.warning("Bon can not be parsed")
-                if (self._use_pdf_in_mail()
-                        and (
-                                part.get_content_type() == 'application/octet-stream'
-                                or part.get_content_type() == 'application/pdf'
-                        )):
-
-                    # When decode=True, get_payload will return None if part.is_multipart()
-                    # and the decoded content otherwise.
-                    payload = part.get_payload(decode=True)
-
-                    # Default filename can be passed as an argument to get_filename()
-                    filename = part.get_filename()
-
-                    # Save the file.
-                    if payload and filename:
-                        with open(filename, 'wb') as f:
-                            f.write(payload)
-                        try:
-                            pdf = PdfReader(open(filename, 'rb'))
-                            bon = self._get_bon_from_pdf(pdf, email_timestamp)
-                        except:
-                            pass
-                        os.remove(filename)
-                        if bon is None:
-                            logging.warning("Bon can not be parsed")
-                if bon is not None:
-                    break
+    @functools.cached_property
+    def _search_rules(self) -> Dict[str, List[str]]:
+        # The FROM/SUBJECT keys of the search query, parsed once per adapter as they do not depend on the date
+        rules = dict()
+        for group in imapparser.parse(self._search_query):
+            if not isinstance(group, list) or not all(isinstance(value, bytes) for value in group):
+                continue
+            if len(group) == 2:
+                key, value = group[0].decode().upper(), group[1]
+            elif len(group) == 3 and group[0].upper() == b'HEADER':
+                # HEADER From/Subject are checked like FROM/SUBJECT, other headers only narrow the server search
+                key, value = group[1].decode().upper(), group[2]
+            else:
+                continue
+            if key in _ROUTING_KEYS:
+                rules.setdefault(key, list()).append(value.decode().lower())
+        return rules
+
+    def matches(self, from_header: str, subject_header: str) -> bool:
+        # Same semantics as the FROM/SUBJECT search keys of the IMAP server: case-insensitive substrings
+        rules = self._search_rules
+        headers = {'FROM': from_header.lower(), 'SUBJECT': subject_header.lower()}
+        for key, header in headers.items():
+            if not all(value in header for value in rules.get(key, [])):
+                return False
+        return True
+
+    def is_wanted_part(self, content_type: str, filename: Optional[str] = None) -> bool:
+        return self.rank_part(content_type, filename) is not None
+
+    def rank_part(self, content_type: str, filename: Optional[str] = None) -> Optional[int]:
+        # The order in which the parts of a mail are tried (lowest first), None for parts the adapter does not use.
+        # PDFs come first, anonymous binary attachments last, as they are the most expensive to rule out.
+        is_pdf_file = filename is not None and filename.lower().endswith('.pdf')
+        if self._use_pdf_in_mail() and (content_type == 'application/pdf'
+                                        or (content_type in _PDF_CONTENT_TYPES and is_pdf_file)):
+            return 0
+        if self._use_plain_text_in_mail() and content_type == 'text/plain':
+            return 1
+        if self._use_html_text_in_mail() and content_type == 'text/html':
+            return 2
+        if self._use_pdf_in_mail() and content_type == 'application/octet-stream':
+            return 3
+        return None
+
+    def parse_message(self, message: Union[bytes, Message], email_timestamp: datetime,
+                      pdf_executor: Optional[Executor] = None) -> Optional[BonSummary]:
+        if isinstance(message, bytes):
+            message = _message_parser.parsebytes(message)
+        # When decode=True, get_payload will return None if part.is_multipart() and the decoded content otherwise
+        parts = [MailPart(content_type=part.get_content_type(), filename=part.get_filename(),
+                          charset=part.get_content_charset(), load=functools.partial(part.get_payload, decode=True))
+                 for part in message.walk() if self.is_wanted_part(part.get_content_type())]
+        return self.parse_parts(parts, email_timestamp, pdf_executor)
+
+    def parse_parts(self, parts: Iterable[MailPart], email_timestamp: datetime,
+                    pdf_executor: Optional[Executor] = None) -> Optional[BonSummary]:
+        # Tries the wanted parts from the most to the least promising one and stops at the first bon
+        ranked = [(rank, index, part) for index, part in enumerate(parts)
+                  if (rank := self.rank_part(part.content_type, part.filename)) is not None]
+        ranked.sort(key=lambda candidate: candidate[:2])
+        for _, _, part in ranked:
+            bon = self.parse_part(part.content_type, part.load(), part.filename, email_timestamp, pdf_executor,
+                                  part.charset)
             if bon is not None:
-                if bon.get_id() in published_ids:
-                    logging.debug(f"Skipping ID {bon.get_id()} ({self.adapter_name()}), already published!")
-                else:
-                    result.append(bon)
-        logging.debug(f"Found {len(result)} bons")
-        return result
+                return bon
+        if len(ranked) > 0:
+            logging.warning("Bon can not be parsed")
+        return None
+
+    @contextmanager
+    def _open_pdf(self, payload: bytes) -> Iterator[BinaryIO]:
+        if len(payload) <= self.config.pdf_max_in_memory_size:
+            yield io.BytesIO(payload)
+            return
+        # Spill large attachments to a private (0700) temporary directory
+        with tempfile.TemporaryDirectory(prefix="mail2cospend-") as directory:
+            path = os.path.join(directory, "attachment.pdf")
+            with open(path, 'wb') as f:
+                f.write(payload)
+            with open(path, 'rb') as f:
+                yield f
+
+    def _parse_pdf(self, payload: bytes, email_timestamp: datetime) -> Optional[BonSummary]:
+        # Imported here, so PyPDF2 is only loaded if an enabled adapter actually parses a PDF
+        from PyPDF2 import PdfReader
+        with self._open_pdf(payload) as pdf_file:
+            try:
+                pdf = PdfDocument(PdfReader(pdf_file))
+                return self._get_bon_from_pdf(pdf, email_timestamp)
+            except:
+                return None
+
+    def _decode_text(self, payload: bytes, charset: Optional[str]) -> Iterator[str]:
+        try:
+            text = payload.decode(charset or self._coding, errors='replace')
+        except LookupError:
+            text = payload.decode(self._coding, errors='replace')
+        return _iter_lines(text)
+
+    def parse_part(self, content_type: str, payload: Optional[bytes], filename: Optional[str],
+                   email_timestamp: datetime, pdf_executor: Optional[Executor] = None,
+                   charset: Optional[str] = None) -> Optional[BonSummary]:
+        bon = None
+        if payload is None:
+            return None
+        if self._use_html_text_in_mail() and content_type == 'text/html':
+            bon = self._get_bon_from_text(self._decode_text(payload, charset), email_timestamp, is_html=True)
+        if self._use_plain_text_in_mail() and content_type == 'text/plain':
+            bon = self._get_bon_from_text(self._decode_text(payload, charset), email_timestamp, is_html=False)
+        # A PDF has its header within the first 1024 bytes, anything else is not worth handing to PyPDF2
+        if self._use_pdf_in_mail() and content_type in _PDF_CONTENT_TYPES and b'%PDF' in payload[:1024]:
+            if pdf_executor is not None:
+                # Parse in a worker process, PDF parsing is CPU bound
+                bon = pdf_executor.submit(self._parse_pdf, payload, email_timestamp).result()
+            else:
+                bon = self._parse_pdf(payload, email_timestamp)
+        return bon
 
     @abstractmethod
-    def _get_bon_from_pdf(self, pdf: PdfReader, email_timestamp: datetime) -> Optional[BonSummary]:
+    def _get_bon_from_pdf(self, pdf: PdfDocument, email_timestamp: datetime) -> Optional[BonSummary]:
         return None
 
     @abstractmethod
     def _get_bon_from_text(self, payload: Iterable[str], email_timestamp: datetime, is_html: bool) -> Optional[
         BonSummary]:
         return None
+
+
+def _iter_lines(text: str) -> Iterator[str]:
+    # Like text.split("\r\n"), without building the list, so adapters which stop early skip the rest of the text
+    start = 0
+    while True:
+        end = text.find("\r\n", start)
+        if end == -1:
+            yield text[start:]
+            return
+        yield text[start:end]
+        start = end + 2
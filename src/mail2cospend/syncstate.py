@@ -0,0 +1,86 @@
+import json
+import logging
+import os
+from datetime import datetime
+from typing import Container, Dict, Optional, Tuple
+
+from mail2cospend.config import Config
+
+
+# Stores the UIDVALIDITY and the last processed UID per mailbox and adapter, so that each cycle only
+# needs to request the mails which arrived after the last run. The date the newest processed mail was
+# received (INTERNALDATE) lets the search be narrowed to a date window as well.
+class SyncState:
+
+    def __init__(self, path: str = os.path.join("data", "sync_state.json")):
+        self.path = path
+        self._state: Dict[str, Dict[str, dict]] = self._load()
+        # (mailbox, adapter) -> {uid: (id of the unpublished bon or None, date the mail was received)}
+        self._pending: Dict[Tuple[str, str], Dict[int, Tuple[Optional[str], Optional[datetime]]]] = dict()
+
+    @classmethod
+    def from_config(cls, config: Config) -> 'SyncState':
+        # Each account of the accounts file has its own state, as the mailbox names of the accounts overlap
+        if config.account_name is None:
+            return cls()
+        return cls(os.path.join("data", f"sync_state_{config.account_name}.json"))
+
+    def _load(self) -> Dict[str, Dict[str, dict]]:
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return dict()
+        except (ValueError, OSError):
+            logging.warning(f"Sync state {self.path} can not be read, performing a full rescan")
+            return dict()
+
+    def get_last_uid(self, mailbox: str, adapter: str, uidvalidity: int, since: str) -> int:
+        entry = self._state.get(mailbox, dict()).get(adapter)
+        if entry is not None:
+            if entry.get('uidvalidity') != uidvalidity:
+                logging.info(f"UIDVALIDITY of {mailbox} changed, performing a full rescan for {adapter}")
+                entry = None
+            elif entry.get('since') != since:
+                logging.info(f"SINCE changed, performing a full rescan for {adapter}")
+                entry = None
+        if entry is None:
+            entry = dict(uidvalidity=uidvalidity, since=since, last_uid=0)
+            self._state.setdefault(mailbox, dict())[adapter] = entry
+        return entry['last_uid']
+
+    def get_last_date(self, mailbox: str, adapter: str) -> Optional[datetime]:
+        # The date (UTC) the newest mail up to the high-water mark was received, call get_last_uid first
+        last_date = self._state.get(mailbox, dict()).get(adapter, dict()).get('last_date')
+        if not last_date:
+            return None
+        return datetime.fromisoformat(last_date)
+
+    def track(self, mailbox: str, adapter: str, uid: int, bon_id: Optional[str],
+              date: Optional[datetime] = None):
+        # bon_id is None if the mail did not contain an unpublished bon
+        self._pending.setdefault((mailbox, adapter), dict())[uid] = (bon_id, date)
+
+    def commit(self, published_ids: Container[str]):
+        # Advance the high-water mark up to the first mail whose bon is not yet published,
+        # so that failed bons are requested again in the next cycle.
+        for (mailbox, adapter), uids in self._pending.items():
+            entry = self._state[mailbox][adapter]
+            for uid in sorted(uids):
+                bon_id, date = uids[uid]
+                if bon_id is not None and bon_id not in published_ids:
+                    break
+                entry['last_uid'] = max(entry['last_uid'], uid)
+                if date is not None and date.isoformat() > entry.get('last_date', ''):
+                    entry['last_date'] = date.isoformat()
+        self._pending.clear()
+        self.save()
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.mkdir(directory)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self._state, f, indent=2)
+        os.replace(tmp_path, self.path)